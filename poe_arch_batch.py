@@ -0,0 +1,109 @@
+"""
+Headless batch scanner for saved Path of Exile screenshots.
+
+Scans every image on a pool of worker processes and prints one JSON line per image with the found items and the
+available recipes. Doesn't need tkinter or a display. Run it from the project directory, like the overlay.
+
+    python poe_arch_batch.py "Screenshots/*.png" --workers 8 > results.jsonl
+"""
+import sys
+import os
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, List, Dict, Optional
+
+import cv2
+
+from poe_arch_engine import ArchnemesisItemsMap, ImageScanner, RecipePlanner, add_scanner_arguments, create_scanner, scan_screenshot
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# Scanners of the worker process keyed by the screen size, so the templates stay warm between the images
+_scanners: Dict[Tuple[int, int], ImageScanner] = dict()
+_planner = None
+_options = None
+
+
+def find_images(patterns: List[str]) -> List[str]:
+    """
+    Expand the directories and glob patterns into the sorted list of image files
+    """
+    images = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            paths = glob.glob(pattern)
+        images.extend(sorted(path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path)))
+    return images
+
+
+def _init_worker(options: argparse.Namespace) -> None:
+    global _options
+    _options = options
+
+
+def _get_scanner(screen_width: int, screen_height: int) -> ImageScanner:
+    scanner = _scanners.get((screen_width, screen_height))
+    if scanner is None:
+        # The images are already scanned in parallel, one thread per process is enough
+        scanner = create_scanner(screen_width, screen_height, _options, 1)
+        _scanners[(screen_width, screen_height)] = scanner
+    return scanner
+
+
+def _get_planner(items_map: ArchnemesisItemsMap) -> RecipePlanner:
+    global _planner
+    if _planner is None:
+        _planner = RecipePlanner(items_map)
+    return _planner
+
+
+def scan_file(path: str) -> Dict:
+    try:
+        return _scan_file(path)
+    except Exception as e:
+        # One broken image (e.g. smaller than the scanner window) must not stop the whole run
+        return {'image': path, 'error': str(e) or repr(e)}
+
+
+def _scan_file(path: str) -> Dict:
+    start = time.perf_counter()
+    screen = cv2.imread(path, cv2.IMREAD_COLOR)
+    if screen is None:
+        return {'image': path, 'error': 'unable to read the image'}
+    screen_height, screen_width = screen.shape[:2]
+    scanner = _get_scanner(screen_width, screen_height)
+    result = {'image': path}
+    result.update(scan_screenshot(scanner, _get_planner(scanner.items_map), screen, _options.combos))
+    result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Scan saved screenshots for archnemesis items and print one JSON line per image')
+    parser.add_argument('images', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: CPU count)')
+    add_scanner_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    options = parse_args(argv)
+    images = find_images(options.images)
+    if len(images) == 0:
+        print('No images found', file=sys.stderr)
+        return 1
+
+    with ProcessPoolExecutor(max_workers=options.workers, initializer=_init_worker, initargs=(options,)) as executor:
+        # Results are streamed in the input order as soon as they are ready
+        for result in executor.map(scan_file, images):
+            print(json.dumps(result), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Benchmark for the scanner on synthetic archnemesis inventories.
+
+Builds inventories from the source pictures at several screen resolutions, optionally with noise and JPEG artifacts,
+scans them headlessly with every requested scanner mode and prints a JSON report with the scan latency, the time
+to match every template, precision/recall against the known items and the peak memory.
+
+    python poe_arch_bench.py --resolutions 1920x1080 2560x1440 --modes full grid pyramid --output bench.json
+"""
+import sys
+import time
+import json
+import argparse
+import tracemalloc
+from typing import Tuple, List, Dict, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from poe_arch_engine import ArchnemesisItemsMap, ImageScanner, calculate_default_scale, parse_resolution, tracer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Background color of the archnemesis inventory slots (the same one the scan images use)
+BACKGROUND_COLOR = (10, 10, 32)
+GRID_SIZE = 8
+# Distance between the neighbouring slots relative to the image size
+SLOT_PITCH = 1.04
+
+MODES = {
+    'full': dict(),
+    'grid': dict(grid_mode=True),
+    'pyramid': dict(pyramid_factor=2.0),
+    'working': dict(working_size=32),
+    'working-grid': dict(working_size=32, grid_mode=True),
+    'cascade': dict(cascade=True),
+}
+
+
+def make_inventory(items_map: ArchnemesisItemsMap, window_size: Tuple[int, int], rng: np.random.Generator, fill: float = 0.75, noise: float = 0.0, jpeg_quality: Optional[int] = None):
+    """
+    Draw a random inventory into the scanner window sized BGR image. Returns the image and the list of placed items
+    with the location where the scanner is expected to find them.
+    """
+    width, height = window_size
+    image = Image.new('RGB', window_size, BACKGROUND_COLOR)
+    image_width, image_height = items_map.image_size
+    pitch = int(image_width * SLOT_PITCH)
+    origin = (int(0.02 * width), int(0.02 * height))
+    items = [item for item in items_map.items()]
+    truth = []
+    for row in range(GRID_SIZE):
+        for column in range(GRID_SIZE):
+            if rng.random() > fill:
+                continue
+            item = items[rng.integers(len(items))]
+            x, y = origin[0] + column * pitch, origin[1] + row * pitch
+            picture = Image.open(f'pictures/{item}.png').convert('RGBA')
+            picture = picture.resize((int(picture.width * items_map.scale), int(picture.height * items_map.scale)))
+            if x + picture.width > width or y + picture.height > height:
+                continue
+            image.paste(picture, (x, y), picture)
+            # The scan images are cropped, see ArchnemesisItemsMap._create_scan_image
+            truth.append((item, (x + int(picture.width / 6), y + int(picture.height / 10))))
+
+    screen = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    if noise > 0:
+        screen = np.clip(screen + rng.normal(0, noise, screen.shape), 0, 255).astype(np.uint8)
+    if jpeg_quality is not None:
+        _, encoded = cv2.imencode('.jpg', screen, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        screen = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    return screen, truth
+
+
+def score(results: Dict[str, List[Tuple[int, int]]], truth: List[Tuple[str, Tuple[int, int]]], radius: int) -> Tuple[int, int, int]:
+    """
+    Count true positives, false positives and false negatives. A detection matches the placed item of the same
+    name within the radius, every placed item could be matched once.
+    """
+    unmatched = list(truth)
+    true_positives = 0
+    false_positives = 0
+    for item, locations in results.items():
+        for x, y in locations:
+            for i, (truth_item, (truth_x, truth_y)) in enumerate(unmatched):
+                if truth_item == item and abs(truth_x - x) <= radius and abs(truth_y - y) <= radius:
+                    del unmatched[i]
+                    true_positives += 1
+                    break
+            else:
+                false_positives += 1
+    return (true_positives, false_positives, len(unmatched))
+
+
+def template_match_times(scanner: ImageScanner, screen: np.ndarray) -> Dict[str, float]:
+    """
+    Time of one full window matchTemplate for every item in ms
+    """
+    times = dict()
+    for item in scanner.items_map.items():
+        start = time.perf_counter()
+        cv2.matchTemplate(screen, scanner.items_map.get_scan_image(item), cv2.TM_CCOEFF_NORMED)
+        times[item] = round((time.perf_counter() - start) * 1000, 3)
+    return times
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # Linux reports kilobytes, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def run_benchmark(resolution: Tuple[int, int], mode: str, options: argparse.Namespace) -> Dict:
+    screen_width, screen_height = resolution
+    items_map = ArchnemesisItemsMap(calculate_default_scale(screen_width, screen_height))
+    scanner = ImageScanner(screen_width, screen_height, items_map)
+    scanner.confidence_threshold = options.threshold
+    if options.workers is not None:
+        scanner.workers = options.workers
+    for name, value in MODES[mode].items():
+        setattr(scanner, name, value)
+    window_size = scanner.scanner_window_size[2:]
+    radius = max(int(items_map.image_size[0] / 2), 1)
+    rng = np.random.default_rng(options.seed)
+
+    # Warm up the caches (and find the grid in grid mode) on an inventory which is not measured
+    warmup, _ = make_inventory(items_map, window_size, rng, noise=options.noise, jpeg_quality=options.jpeg_quality)
+    scanner.scan_image(warmup)
+
+    inventories = [make_inventory(items_map, window_size, rng, noise=options.noise, jpeg_quality=options.jpeg_quality) for _ in range(options.iterations)]
+    latencies = []
+    cascade_stats = []
+    true_positives = false_positives = false_negatives = 0
+    for screen, truth in inventories:
+        start = time.perf_counter()
+        results = scanner.scan_image(screen)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if scanner.cascade:
+            cascade_stats.append(scanner.cascade_stats)
+        tp, fp, fn = score(results, truth, radius)
+        true_positives += tp
+        false_positives += fp
+        false_negatives += fn
+
+    # tracemalloc slows down every allocation, so the peak memory is measured in a separate untimed pass
+    tracemalloc.start()
+    for screen, _ in inventories:
+        scanner.scan_image(screen)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'mode': mode,
+        'resolution': [screen_width, screen_height],
+        'scale': items_map.scale,
+        'window_size': list(window_size),
+        'noise': options.noise,
+        'jpeg_quality': options.jpeg_quality,
+        'iterations': options.iterations,
+        'latency_ms': {
+            'p50': round(float(np.percentile(latencies, 50)), 3),
+            'p95': round(float(np.percentile(latencies, 95)), 3),
+            'mean': round(float(np.mean(latencies)), 3),
+        },
+        'precision': round(true_positives / max(true_positives + false_positives, 1), 4),
+        'recall': round(true_positives / max(true_positives + false_negatives, 1), 4),
+        'peak_traced_mb': round(peak_traced / (1024 * 1024), 1),
+        'peak_rss_mb': peak_rss_mb(),
+        'template_bytes': items_map.memory_usage()['bytes'],
+        'cascade': {
+            'clusters': cascade_stats[-1]['clusters'],
+            'pruned': round(float(np.mean([stats['pruned'] for stats in cascade_stats])), 1),
+            'saved_ms': round(float(np.mean([stats['saved_ms'] for stats in cascade_stats])), 3),
+        } if cascade_stats else None,
+        'template_match_ms': template_match_times(scanner, screen) if options.template_times else None,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the scanner on synthetic inventories')
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=[(1920, 1080), (2560, 1440), (3840, 2160)], help='screen resolutions as WIDTHxHEIGHT')
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES), help='scanner modes to compare')
+    parser.add_argument('--iterations', type=int, default=10, help='number of measured scans per resolution and mode')
+    parser.add_argument('--noise', type=float, default=0.0, help='standard deviation of the gaussian noise added to the inventory')
+    parser.add_argument('--jpeg-quality', type=int, default=None, help='compress the inventory with JPEG of this quality')
+    parser.add_argument('--threshold', type=float, default=0.94, help='confidence threshold')
+    parser.add_argument('--workers', type=int, default=None, help='scanner threads (default: CPU count)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random inventories')
+    parser.add_argument('--no-template-times', dest='template_times', action='store_false', help="don't measure every template separately")
+    parser.add_argument('--output', default=None, help='write the JSON report into this file instead of stdout')
+    parser.add_argument('--trace', default=None, help='record the scan stages and save them into this file in the Chrome trace format')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    options = parse_args(argv)
+    tracer.enabled = options.trace is not None
+    runs = []
+    for resolution in options.resolutions:
+        for mode in options.modes:
+            run = run_benchmark(resolution, mode, options)
+            runs.append(run)
+            print(f'{resolution[0]}x{resolution[1]} {mode}: p50={run["latency_ms"]["p50"]} ms p95={run["latency_ms"]["p95"]} ms precision={run["precision"]} recall={run["recall"]}', file=sys.stderr)
+
+    if options.trace is not None:
+        tracer.dump(options.trace)
+
+    report = json.dumps({'runs': runs}, indent=2)
+    if options.output is None:
+        print(report)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
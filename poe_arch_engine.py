@@ -0,0 +1,2255 @@
+from typing import Callable, Any, Tuple, List, Dict, Optional
+import os
+import sys
+import json
+import time
+import argparse
+import queue
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image, ImageGrab
+
+try:
+    import mss
+except ImportError:
+    # Optional faster screen capture
+    mss = None
+
+DEFAULT_COMBOS = [
+    ['Innocence-Touched', 'Brine King-Touched', 'Kitava-Touched', 'Treant Horde'],
+    ['Mirror Image', 'Assassin', 'Rejuvenating', 'Treant Horde'],
+    ['Innocence-Touched', 'Brine King-Touched', 'Kitava-Touched', 'Treant Horde'],
+    ['Arakaali-Touched', 'Brine King-Touched', 'Effigy', 'Treant Horde']
+]
+
+
+class _Span:
+    """
+    Timed span recorded by Tracer when the with block exits
+    """
+    __slots__ = ('_tracer', '_name', '_args', '_start')
+
+    def __init__(self, tracer: 'Tracer', name: str, args: Dict[str, Any]):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = 0
+
+    def set(self, **args) -> None:
+        self._args.update(args)
+
+    def __enter__(self) -> '_Span':
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_) -> None:
+        end = time.perf_counter_ns()
+        self._tracer.record({'name': self._name, 'ph': 'X', 'ts': self._start / 1000, 'dur': (end - self._start) / 1000, 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': self._args})
+
+
+class _NoSpan:
+    """
+    Span used while the tracer is disabled, it does nothing
+    """
+    __slots__ = ()
+
+    def set(self, **args) -> None:
+        pass
+
+    def __enter__(self) -> '_NoSpan':
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+class Tracer:
+    """
+    Records timed spans and counters of the scan stages into a ring buffer, which could be saved in the Chrome trace
+    format (chrome://tracing, https://ui.perfetto.dev). Disabled by default and costs almost nothing until enabled.
+    """
+    def __init__(self, capacity: int = 100000):
+        self._events = collections.deque(maxlen=capacity)
+        self._enabled = False
+
+    def span(self, name: str, **args):
+        """
+        Context manager timing the with block: `with tracer.span('capture'): ...`
+        """
+        if not self._enabled:
+            return _NO_SPAN
+        return _Span(self, name, args)
+
+    def count(self, name: str, values: Dict[str, float]) -> None:
+        if self._enabled:
+            self.record({'name': name, 'ph': 'C', 'ts': time.perf_counter_ns() / 1000, 'pid': os.getpid(), 'args': values})
+
+    def record(self, event: Dict[str, Any]) -> None:
+        # Appending to a deque is thread safe, so the events could be recorded from the scanner threads
+        self._events.append(event)
+
+    def clear(self) -> None:
+        self._events.clear()
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self._events), 'displayTimeUnit': 'ms'}, f)
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value: bool) -> None:
+        self._enabled = value
+
+
+_NO_SPAN = _NoSpan()
+
+# Shared by everything in the process
+tracer = Tracer()
+
+
+class TemplateRecord:
+    """
+    Position of one scan image in the template store
+    """
+    __slots__ = ('offset', 'shape')
+
+    def __init__(self, offset: int, shape: Tuple[int, ...]):
+        self.offset = offset
+        self.shape = shape
+
+
+class TemplateStore:
+    """
+    All scan images of one scale packed into a single contiguous array with the offset and the shape of every image.
+    Every scan image is a contiguous view into it, so the memory use is predictable and the matchers going over all
+    the templates read them in one block.
+    """
+    def __init__(self, buffer: np.ndarray, records: Dict[str, TemplateRecord], image_size: Tuple[int, int]):
+        self._buffer = buffer
+        self._records = records
+        self._image_size = image_size
+        self._views = {item: buffer[record.offset:record.offset + int(np.prod(record.shape))].reshape(record.shape) for item, record in records.items()}
+
+    @staticmethod
+    def pack(items: List[str], scan_images: Dict[str, np.ndarray], image_size: Tuple[int, int]) -> 'TemplateStore':
+        """
+        Copy the scan images into a new store. The copies don't keep the arrays they were cropped from alive.
+        """
+        records = dict()
+        offset = 0
+        for item in items:
+            records[item] = TemplateRecord(offset, scan_images[item].shape)
+            offset += scan_images[item].size
+        buffer = np.empty(offset, dtype=np.uint8)
+        for item in items:
+            record = records[item]
+            buffer[record.offset:record.offset + scan_images[item].size] = scan_images[item].reshape(-1)
+        return TemplateStore(buffer, records, image_size)
+
+    def get(self, item: str) -> np.ndarray:
+        return self._views[item]
+
+    def release(self) -> None:
+        """
+        Drop the store's references to its buffer. The buffer is freed (or unmapped) once nobody uses its views.
+        """
+        self._views = dict()
+        self._records = dict()
+        self._buffer = None
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """
+        Number of the scan images, the size of their buffer in bytes and whether it's memory mapped from the cache
+        """
+        return {
+            'templates': len(self._records),
+            'bytes': int(self._buffer.nbytes) if self._buffer is not None else 0,
+            'memory_mapped': isinstance(self._buffer, np.memmap),
+        }
+
+    @property
+    def buffer(self) -> Optional[np.ndarray]:
+        return self._buffer
+
+    @property
+    def records(self) -> Dict[str, TemplateRecord]:
+        return self._records
+
+    @property
+    def image_size(self) -> Tuple[int, int]:
+        return self._image_size
+
+
+class TemplateCache:
+    """
+    Keeps the scan images for every used scale on disk, so they don't have to be rebuilt from the source pictures.
+    All scan images for one scale are stored in a single flat .npy file which is memory mapped when loaded.
+    A small json index next to it holds the offset and the shape of every image and the signature of the sources.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir: str = 'template_cache', pictures_dir: str = 'pictures'):
+        self._cache_dir = cache_dir
+        self._pictures_dir = pictures_dir
+
+    def load(self, scale: float, items: List[str]) -> Optional[TemplateStore]:
+        """
+        Return the store of the scan images backed by the memory mapped cache file, or None if the cache is stale
+        """
+        data_file, index_file = self._paths(scale)
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+            if index.get('version') != TemplateCache.VERSION or index.get('signature') != self._signature(items):
+                return None
+            data = np.load(data_file, mmap_mode='r')
+            records = dict()
+            for item in items:
+                offset, shape = index['images'][item]
+                records[item] = TemplateRecord(offset, tuple(shape))
+            return TemplateStore(data, records, tuple(index['image_size']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, scale: float, items: List[str], store: TemplateStore) -> None:
+        data_file, index_file = self._paths(scale)
+        try:
+            index = {
+                'version': TemplateCache.VERSION,
+                'signature': self._signature(items),
+                'image_size': store.image_size,
+                'images': {item: (record.offset, record.shape) for item, record in store.records.items()},
+            }
+            os.makedirs(self._cache_dir, exist_ok=True)
+            self._write_atomically(data_file, lambda f: np.save(f, store.buffer))
+            self._write_atomically(index_file, lambda f: f.write(json.dumps(index).encode()))
+        except OSError as e:
+            print(f'Unable to save the template cache: {e}', file=sys.stderr)
+
+    def _write_atomically(self, path: str, write: Callable[[Any], Any]) -> None:
+        """
+        Write into a temporary file of this writer first, so neither the concurrent readers see a partial file nor
+        the concurrent writers (e.g. the batch scanner processes) overwrite each other's temporary file
+        """
+        descriptor, temporary_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                write(f)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def _paths(self, scale: float) -> Tuple[str, str]:
+        name = os.path.join(self._cache_dir, f'scan_images_{scale:.6f}')
+        return (name + '.npy', name + '.json')
+
+    def _signature(self, items: List[str]) -> str:
+        # Any change to the source pictures changes their modification time or size
+        signature = hashlib.sha1()
+        for item in items:
+            stat = os.stat(os.path.join(self._pictures_dir, f'{item}.png'))
+            signature.update(f'{item}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+        return signature.hexdigest()
+
+
+class DisplayImages:
+    """
+    Tk images of one item shown by the overlay
+    """
+    __slots__ = ('image', 'small_image')
+
+    def __init__(self, image, small_image):
+        self.image = image
+        self.small_image = small_image
+
+
+class ArchnemesisItemsMap:
+    """
+    Holds the information about all archnemesis items, recipes, images and map them together
+    """
+    # Put everything into the list so we could maintain the display order
+    ARCH_ITEMS = [
+        ('Kitava-Touched', ['Tukohama-Touched', 'Abberath-Touched', 'Corrupter', 'Corpse Detonator']),
+        ('Innocence-Touched', ['Lunaris-Touched', 'Solaris-Touched', 'Mirror Image', 'Mana Siphoner']),
+        ('Shakari-Touched', ['Entangler', 'Soul Eater', 'Drought Bringer']),
+        ('Abberath-Touched', ['Flame Strider', 'Frenzied', 'Rejuvenating']),
+        ('Tukohama-Touched', ['Bonebreaker', 'Executioner', 'Magma Barrier']),
+        ('Brine King-Touched', ['Ice Prison', 'Storm Strider', 'Heralding Minions']),
+        ('Arakaali-Touched', ['Corpse Detonator', 'Entangler', 'Assassin']),
+        ('Solaris-Touched', ['Invulnerable', 'Magma Barrier', 'Empowered Minions']),
+        ('Lunaris-Touched', ['Invulnerable', 'Frost Strider', 'Empowered Minions']),
+        ('Effigy', ['Hexer', 'Malediction', 'Corrupter']),
+        ('Empowered Elements', ['Evocationist', 'Steel-Infused', 'Chaosweaver']),
+        ('Crystal-Skinned', ['Permafrost', 'Rejuvenating', 'Berserker']),
+        ('Invulnerable', ['Sentinel', 'Juggernaut', 'Consecrator']),
+        ('Corrupter', ['Bloodletter', 'Chaosweaver']),
+        ('Mana Siphoner', ['Consecrator', 'Dynamo']),
+        ('Storm Strider', ['Stormweaver', 'Hasted']),
+        ('Mirror Image', ['Echoist', 'Soul Conduit']),
+        ('Magma Barrier', ['Incendiary', 'Bonebreaker']),
+        ('Evocationist', ['Flameweaver', 'Frostweaver', 'Stormweaver']),
+        ('Corpse Detonator', ['Necromancer', 'Incendiary']),
+        ('Flame Strider', ['Flameweaver', 'Hasted']),
+        ('Soul Eater', ['Soul Conduit', 'Necromancer', 'Gargantuan']),
+        ('Ice Prison', ['Permafrost', 'Sentinel']),
+        ('Frost Strider', ['Frostweaver', 'Hasted']),
+        ('Treant Horde', ['Toxic', 'Sentinel', 'Steel-Infused']),
+        ('Temporal Bubble', ['Juggernaut', 'Hexer', 'Arcane Buffer']),
+        ('Entangler', ['Toxic', 'Bloodletter']),
+        ('Drought Bringer', ['Malediction', 'Deadeye']),
+        ('Hexer', ['Chaosweaver', 'Echoist']),
+        ('Executioner', ['Frenzied', 'Berserker']),
+        ('Rejuvenating', ['Gargantuan', 'Vampiric']),
+        ('Necromancer', ['Bombardier', 'Overcharged']),
+        ('Trickster', ['Overcharged', 'Assassin', 'Echoist']),
+        ('Assassin', ['Deadeye', 'Vampiric']),
+        ('Empowered Minions', ['Necromancer', 'Executioner', 'Gargantuan']),
+        ('Heralding Minions', ['Dynamo', 'Arcane Buffer']),
+        ('Arcane Buffer', []),
+        ('Berserker', []),
+        ('Bloodletter', []),
+        ('Bombardier', []),
+        ('Bonebreaker', []),
+        ('Chaosweaver', []),
+        ('Consecrator', []),
+        ('Deadeye', []),
+        ('Dynamo', []),
+        ('Echoist', []),
+        ('Flameweaver', []),
+        ('Frenzied', []),
+        ('Frostweaver', []),
+        ('Gargantuan', []),
+        ('Hasted', []),
+        ('Incendiary', []),
+        ('Juggernaut', []),
+        ('Malediction', []),
+        ('Opulent', []),
+        ('Overcharged', []),
+        ('Permafrost', []),
+        ('Sentinel', []),
+        ('Soul Conduit', []),
+        ('Steel-Infused', []),
+        ('Stormweaver', []),
+        ('Toxic', []),
+        ('Vampiric', []),
+        ('Combo', []),
+    ]
+
+    def __init__(self, scale: float, load_in_background: bool = False):
+        self._scale = scale
+        self._store = None
+        self._display_images = dict()
+        self._template_cache = TemplateCache()
+        # The scan images are built on a single background thread, so the requests are handled in order
+        self._loader = ThreadPoolExecutor(max_workers=1) if load_in_background else None
+        self._images_ready = None
+        self._update_images_later(scale)
+
+    def _update_images_later(self, scale):
+        self._scale = scale
+        # Display images are created on the first use because only a few of them are usually shown
+        self._display_images = dict()
+        if self._loader is None:
+            self._update_images(scale)
+            return
+        if self._images_ready is not None:
+            # The outdated request is not needed anymore if it hasn't started yet
+            self._images_ready.cancel()
+        self._images_ready = self._loader.submit(self._update_images, scale)
+
+    def _update_images(self, scale):
+        items = [item for item, _ in ArchnemesisItemsMap.ARCH_ITEMS]
+        # Building the scan images is expensive, so try the precomputed ones first
+        store = self._template_cache.load(scale, items)
+        if store is None:
+            scan_images = dict()
+            for item in items:
+                image = self._load_image(item, scale)
+                image_size = image.size
+                scan_images[item] = self._create_scan_image(image)
+            store = TemplateStore.pack(items, scan_images, image_size)
+            self._template_cache.save(scale, items, store)
+        previous_store, self._store = self._store, store
+        if previous_store is not None:
+            previous_store.release()
+
+    def _wait_for_images(self) -> None:
+        if self._images_ready is not None:
+            self._images_ready.result()
+
+    def add_images_ready_callback(self, callback: Callable[[], Any]) -> None:
+        """
+        Call the callback once the scan images for the current scale are ready. It may be called from the loader thread.
+        """
+        if self._images_ready is None:
+            callback()
+        else:
+            self._images_ready.add_done_callback(lambda _: callback())
+
+    def create_scan_image(self, item: str, scale: float) -> np.ndarray:
+        """
+        Build the scan image of the item for any scale, without changing the scale of the map
+        """
+        return self._create_scan_image(self._load_image(item, scale))
+
+    def _load_image(self, item: str, scale: float):
+        image = Image.open(f'pictures/{item}.png')
+        # Scale the image according to the input parameter
+        return image.resize((int(image.width * scale), int(image.height * scale)))
+
+    def _create_scan_image(self, image):
+        # Remove alpha channel and replace it with predefined background color
+        background = Image.new('RGBA', image.size, (10, 10, 32))
+        image_without_alpha = Image.alpha_composite(background, image)
+        scan_template = cv2.cvtColor(np.array(image_without_alpha), cv2.COLOR_RGB2BGR)
+        w, h, _ = scan_template.shape
+
+        # Crop the image to help with scanning
+        return scan_template[int(h * 1.0 / 10):int(h * 2.3 / 3), int(w * 1.0 / 6):int(w * 5.5 / 6)]
+
+    def _create_display_images(self, item):
+        # Imported here because ImageTk needs tkinter, which the headless tools don't have to load
+        from PIL import ImageTk
+        image = self._load_image(item, self._scale)
+        # Convert the image to Tk image because we're going to display it
+        self._display_images[item] = DisplayImages(ImageTk.PhotoImage(image=image), ImageTk.PhotoImage(image=image.resize((30, 30))))
+
+    def get_scan_image(self, item):
+        self._wait_for_images()
+        return self._store.get(item)
+
+    def get_display_image(self, item):
+        if item not in self._display_images:
+            self._create_display_images(item)
+        return self._display_images[item].image
+
+    def get_display_small_image(self, item):
+        if item not in self._display_images:
+            self._create_display_images(item)
+        return self._display_images[item].small_image
+
+    def items(self):
+        for item, _ in ArchnemesisItemsMap.ARCH_ITEMS:
+            yield item
+
+    def recipes(self):
+        for item, recipe in ArchnemesisItemsMap.ARCH_ITEMS:
+            if recipe:
+                yield (item, recipe)
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """
+        Memory used by the scan images of the current scale and the number of the items with display images
+        """
+        self._wait_for_images()
+        usage = self._store.memory_usage()
+        usage['display_images'] = len(self._display_images)
+        return usage
+
+    @property
+    def image_size(self):
+        self._wait_for_images()
+        return self._store.image_size
+
+    @property
+    def scale(self) -> float:
+        return self._scale
+
+    @scale.setter
+    def scale(self, scale: float) -> None:
+        if scale != self._scale:
+            self._update_images_later(scale)
+
+
+class InventoryGrid:
+    """
+    Describes the archnemesis inventory grid inside the scanning window. Every slot is a square cell of `pitch`
+    pixels and the cell origin is the position of a scan template's top left corner inside the first slot.
+    """
+    def __init__(self, origin: Tuple[int, int], pitch: Tuple[float, float], rows: int, columns: int):
+        self._origin = origin
+        self._pitch = pitch
+        self._rows = rows
+        self._columns = columns
+
+    def cells(self):
+        """
+        Yield (x, y) of the template's top left corner for every cell inside the scanning window
+        """
+        for row in range(self._rows):
+            for column in range(self._columns):
+                yield (int(round(self._origin[0] + column * self._pitch[0])), int(round(self._origin[1] + row * self._pitch[1])))
+
+    @staticmethod
+    def from_detections(results: Dict[str, List[Tuple[int, int]]], approximate_pitch: float, window_size: Tuple[int, int], template_size: Tuple[int, int]):
+        """
+        Fit the grid from the locations found by a full window scan. Returns None if there is nothing to fit to.
+        """
+        locations = np.array([loc for locs in results.values() for loc in locs], dtype=np.float64)
+        if len(locations) == 0:
+            return None
+        origin = []
+        pitch = []
+        for axis in range(2):
+            values = locations[:, axis]
+            # Assign every detection to a slot index relative to the leftmost/topmost one and fit a line through them
+            indices = np.round((values - values.min()) / approximate_pitch)
+            if indices.max() > 0:
+                axis_pitch, axis_origin = np.polyfit(indices, values, 1)
+            else:
+                axis_pitch, axis_origin = approximate_pitch, values.mean()
+            # Move the origin to the first slot which still fits into the window
+            axis_origin -= np.floor(axis_origin / axis_pitch) * axis_pitch
+            origin.append(axis_origin)
+            pitch.append(axis_pitch)
+        columns = int((window_size[0] - template_size[0] - origin[0]) // pitch[0]) + 1
+        rows = int((window_size[1] - template_size[1] - origin[1]) // pitch[1]) + 1
+        return InventoryGrid((origin[0], origin[1]), (pitch[0], pitch[1]), rows, columns)
+
+    def translated(self, dx: float, dy: float) -> 'InventoryGrid':
+        return InventoryGrid((self._origin[0] + dx, self._origin[1] + dy), self._pitch, self._rows, self._columns)
+
+    @property
+    def origin(self) -> Tuple[float, float]:
+        return self._origin
+
+    @property
+    def pitch(self) -> Tuple[float, float]:
+        return self._pitch
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    @property
+    def columns(self) -> int:
+        return self._columns
+
+
+class ScanCancelled(Exception):
+    """
+    Raised by ImageScanner when the scan gets cancelled
+    """
+
+
+class ScanProgress:
+    """
+    Lets other threads follow and cancel a running scan
+    """
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._steps = 0
+        self._done = 0
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def check(self) -> None:
+        if self._cancelled.is_set():
+            raise ScanCancelled()
+
+    def add_steps(self, steps: int) -> None:
+        with self._lock:
+            self._steps += steps
+
+    def advance(self) -> None:
+        with self._lock:
+            self._done += 1
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def fraction(self) -> float:
+        with self._lock:
+            return self._done / self._steps if self._steps > 0 else 0.0
+
+
+class CellClassifier:
+    """
+    Nearest neighbour classifier of the inventory grid cells. Every scan image is turned into a fixed-size zero-mean
+    unit-norm descriptor and all of them are stacked into one float32 matrix. The descriptors of all the cells (with
+    a few pixels of jitter around them) are then scored against it with a single matrix multiply. That is the
+    normalized cross-correlation of cv2.TM_CCOEFF_NORMED, but computed only on every stride-th pixel, so the scores
+    approximate the full resolution ones and the confidence threshold is slightly stricter or looser in grid mode.
+    """
+    # Only every n-th pixel of the scan image is used for the descriptor
+    DESCRIPTOR_STRIDE = 2
+
+    def __init__(self, items_map: ArchnemesisItemsMap, stride: int = DESCRIPTOR_STRIDE):
+        self._stride = stride
+        templates = [(item, items_map.get_scan_image(item)) for item in items_map.items()]
+        self._height = max(template.shape[0] for _, template in templates)
+        self._width = max(template.shape[1] for _, template in templates)
+        # Descriptors must have the same size. The few scan images of a different size (made from smaller
+        # pictures) are matched separately with OpenCV.
+        self._items = [item for item, template in templates if template.shape[:2] == (self._height, self._width)]
+        self._other_templates = [(item, template) for item, template in templates if template.shape[:2] != (self._height, self._width)]
+        patches = np.stack([template for item, template in templates if template.shape[:2] == (self._height, self._width)])
+        self._descriptors = np.ascontiguousarray(CellClassifier.descriptors(patches, stride).T)
+
+    @staticmethod
+    def descriptors(patches: np.ndarray, stride: int = DESCRIPTOR_STRIDE) -> np.ndarray:
+        """
+        Turn N BGR patches of the same size into the N x D matrix of their normalized descriptors
+        """
+        patches = patches[:, ::stride, ::stride, :].astype(np.float32)
+        # Like TM_CCOEFF_NORMED, subtract the mean of every channel and normalize over all channels together
+        patches -= patches.mean(axis=(1, 2), keepdims=True)
+        patches = patches.reshape(len(patches), -1)
+        norms = np.linalg.norm(patches, axis=1, keepdims=True)
+        return patches / np.maximum(norms, 1e-6)
+
+    def classify(self, screen: np.ndarray, cells: List[Tuple[int, int]], threshold: float, jitter: int) -> List[Tuple[Optional[str], Optional[Tuple[int, int]], float]]:
+        """
+        Return the best item, its location and the confidence for every cell. Cells where nothing reaches
+        the threshold are empty (None).
+        """
+        offsets = np.array([(dx, dy) for dy in range(-jitter, jitter + 1) for dx in range(-jitter, jitter + 1)])
+        positions = np.array(cells).reshape(-1, 1, 2) + offsets.reshape(1, -1, 2)
+        positions[:, :, 0] = np.clip(positions[:, :, 0], 0, screen.shape[1] - self._width)
+        positions[:, :, 1] = np.clip(positions[:, :, 1], 0, screen.shape[0] - self._height)
+        positions = positions.reshape(-1, 2)
+
+        # Cut all the patches at once from the view of every template sized window of the screen
+        windows = np.lib.stride_tricks.sliding_window_view(screen, (self._height, self._width, 3))[:, :, 0]
+        patches = windows[positions[:, 1], positions[:, 0]]
+        scores = (CellClassifier.descriptors(patches, self._stride) @ self._descriptors).reshape(len(cells), len(offsets) * len(self._items))
+
+        best = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(cells)), best]
+        results = []
+        for cell, (best_score, confidence) in enumerate(zip(best, confidences)):
+            offset, item = divmod(int(best_score), len(self._items))
+            x, y = positions[cell * len(offsets) + offset]
+            results.append((self._items[item], (int(x), int(y)), float(confidence)))
+
+        for item, template in self._other_templates:
+            # The smaller picture sits in the same slot, but its scan image is cropped at a different offset
+            margin_x = self._width - template.shape[1] + jitter
+            margin_y = self._height - template.shape[0] + jitter
+            for cell, (x, y) in enumerate(cells):
+                left, top = max(x - margin_x, 0), max(y - margin_y, 0)
+                area = screen[top:y + self._height + jitter, left:x + self._width + jitter]
+                if area.shape[0] < template.shape[0] or area.shape[1] < template.shape[1]:
+                    continue
+                _, confidence, _, (area_x, area_y) = cv2.minMaxLoc(cv2.matchTemplate(area, template, cv2.TM_CCOEFF_NORMED))
+                if confidence > results[cell][2]:
+                    results[cell] = (item, (left + area_x, top + area_y), float(confidence))
+        return [result if result[2] >= threshold else (None, None, result[2]) for result in results]
+
+
+class TemplateCluster:
+    """
+    Group of similar templates represented by their mean template
+    """
+    __slots__ = ('items', 'template', 'similarity')
+
+    def __init__(self, items: List[str], template: np.ndarray, similarity: float):
+        self.items = items
+        self.template = template
+        # The lowest similarity of a member to the mean template
+        self.similarity = similarity
+
+
+class TemplateCascade:
+    """
+    Clusters the downscaled templates, so that the similar ones (many items share their palettes and shapes) are
+    searched with one match of their mean template. Only the members of the clusters which matched somewhere are
+    matched again, at the full resolution and only around those locations.
+    """
+    # Lowest similarity of the templates put into one cluster
+    CLUSTER_SIMILARITY = 0.8
+
+    def __init__(self, templates: Dict[str, np.ndarray]):
+        self._clusters = []
+        by_shape = collections.defaultdict(list)
+        for item, template in templates.items():
+            by_shape[template.shape].append(item)
+        for items in by_shape.values():
+            self._clusters.extend(TemplateCascade._cluster(items, templates))
+
+    @staticmethod
+    def _cluster(items: List[str], templates: Dict[str, np.ndarray]) -> List[TemplateCluster]:
+        descriptors = CellClassifier.descriptors(np.stack([templates[item] for item in items]), 1)
+        similar = (descriptors @ descriptors.T) >= TemplateCascade.CLUSTER_SIMILARITY
+        unassigned = set(range(len(items)))
+        clusters = []
+        while unassigned:
+            # Greedily take the template with the most similar ones left as the center of the next cluster
+            center = max(sorted(unassigned), key=lambda i: int(similar[i, list(unassigned)].sum()))
+            members = sorted(i for i in unassigned if similar[center, i])
+            unassigned -= set(members)
+            if len(members) == 1:
+                clusters.append(TemplateCluster([items[center]], templates[items[center]], 1.0))
+                continue
+            mean = np.mean([templates[items[i]].astype(np.float32) for i in members], axis=0).round().astype(np.uint8)
+            similarity = float((CellClassifier.descriptors(mean[np.newaxis], 1) @ descriptors[members].T).min())
+            clusters.append(TemplateCluster([items[i] for i in members], mean, similarity))
+        return clusters
+
+    @property
+    def clusters(self) -> List[TemplateCluster]:
+        return self._clusters
+
+
+def match_templates(screen: np.ndarray, templates: Dict[str, np.ndarray], count: int, map_function: Callable = map) -> Tuple[float, List[Tuple[float, str, Tuple[int, int]]]]:
+    """
+    Score the scale the templates are built at: the mean confidence of the count best matching templates on the whole
+    BGR image (-1 if none of them fits into it), and those matches as (confidence, item, location), the most
+    confident first. The map_function(function, values) could run the matching in parallel.
+    """
+    def match(item: str) -> Optional[Tuple[float, str, Tuple[int, int]]]:
+        template = templates[item]
+        if template.shape[0] > screen.shape[0] or template.shape[1] > screen.shape[1]:
+            return None
+        _, confidence, _, location = cv2.minMaxLoc(cv2.matchTemplate(screen, template, cv2.TM_CCOEFF_NORMED))
+        return (confidence, item, location)
+
+    matches = sorted((match for match in map_function(match, list(templates)) if match is not None), reverse=True)[:count]
+    score = float(np.mean([confidence for confidence, _, _ in matches])) if matches else -1.0
+    return (score, matches)
+
+
+class ScaleBank:
+    """
+    Scan images of every item prebuilt at a few scales around the center one. The scales are one source image pixel
+    apart, because the scan images only change when their scaled size does, and already one pixel off drops the
+    confidence under the threshold. The scale of the screen is found in two steps. First every few scales are
+    matched downscaled on the downscaled capture, which finds the best matching items and their places (the
+    downscaled images blur the small scale differences, so the coarse step can't choose the scale by itself). Then
+    only those items are matched at the full resolution around their places at every scale of the bank, which is
+    cheap and tells even the neighbouring scales apart.
+    """
+    # All source images are 78x78, see calculate_default_scale
+    SOURCE_IMAGE_SIZE = 78
+    # Downscale factor of the coarse search
+    SEARCH_FACTOR = 3.0
+    # The coarse search only tries every n-th scale of the bank
+    COARSE_STEP = 3
+    # Number of the best matching items of every coarse scale which are matched at the full resolution
+    SCORED_ITEMS = 8
+    # Number of the best full resolution matches which make the score of a scale. Some of the coarse items are
+    # usually wrong, and they are wrong at every scale.
+    REFINED_ITEMS = 4
+
+    def __init__(self, items_map: ArchnemesisItemsMap, center_scale: float, radius: int):
+        self._center_scale = center_scale
+        self._radius = radius
+        size = int(ScaleBank.SOURCE_IMAGE_SIZE * center_scale)
+        steps = [step for step in range(-radius, radius + 1) if size + step > 0]
+        # Half a pixel up, so the float rounding never truncates the scaled size to the smaller one
+        self._scales = [(size + step + 0.5) / ScaleBank.SOURCE_IMAGE_SIZE for step in steps]
+        self._coarse_indices = [i for i, step in enumerate(steps) if step % ScaleBank.COARSE_STEP == 0]
+        items = list(items_map.items())
+        self._templates = [{item: items_map.create_scan_image(item, scale) for item in items} for scale in self._scales]
+        self._coarse_templates = {i: {item: ImageScanner.downscale(template, ScaleBank.SEARCH_FACTOR) for item, template in self._templates[i].items()} for i in self._coarse_indices}
+
+    def select(self, screen: np.ndarray, confidence_threshold: float, map_function: Callable) -> Optional[float]:
+        """
+        Find the scale of the items in the BGR capture. Returns None if no scale matches them well enough. The
+        map_function(function, values) runs the matching in parallel and returns the results in the values order.
+        """
+        coarse_screen = ImageScanner.downscale(screen, ScaleBank.SEARCH_FACTOR)
+
+        def match_coarse(index: int) -> List[Tuple[float, str, Tuple[int, int]]]:
+            return match_templates(coarse_screen, self._coarse_templates[index], ScaleBank.SCORED_ITEMS)[1]
+
+        with tracer.span('scale bank coarse', scales=len(self._coarse_indices)):
+            coarse = list(map_function(match_coarse, self._coarse_indices))
+        candidates = sorted({(item, (int(x * ScaleBank.SEARCH_FACTOR), int(y * ScaleBank.SEARCH_FACTOR))) for matches in coarse for _, item, (x, y) in matches})
+        if not candidates:
+            return None
+
+        # The coarse places are off by up to the factor, and the other scales change the size by up to the radius
+        margin = int(np.ceil(ScaleBank.SEARCH_FACTOR)) + self._radius + 1
+
+        def refine(index: int) -> float:
+            confidences = []
+            for item, (x, y) in candidates:
+                template = self._templates[index][item]
+                left, top = max(x - margin, 0), max(y - margin, 0)
+                area = screen[top:y + template.shape[0] + margin, left:x + template.shape[1] + margin]
+                if template.shape[0] > area.shape[0] or template.shape[1] > area.shape[1]:
+                    continue
+                confidences.append(cv2.minMaxLoc(cv2.matchTemplate(area, template, cv2.TM_CCOEFF_NORMED))[1])
+            best = sorted(confidences, reverse=True)[:ScaleBank.REFINED_ITEMS]
+            return float(np.mean(best)) if best else -1.0
+
+        with tracer.span('scale bank refine', scales=len(self._scales), items=len(candidates)) as span:
+            scores = list(map_function(refine, range(len(self._scales))))
+            winner = int(np.argmax(scores))
+            span.set(scale=self._scales[winner], score=scores[winner])
+        # The best items of the inventory should all clear the threshold at the right scale
+        if scores[winner] < confidence_threshold:
+            return None
+        return self._scales[winner]
+
+    @property
+    def center_scale(self) -> float:
+        return self._center_scale
+
+    @property
+    def scales(self) -> List[float]:
+        return self._scales
+
+
+class CaptureBackend:
+    """
+    Source of the scanning window images. The returned BGR image may be a view of a buffer which the next capture
+    overwrites, so it must not be kept between the scans.
+    """
+    def capture(self, bbox: Tuple[int, int, int, int]) -> np.ndarray:
+        """
+        Capture the (left, top, right, bottom) screen area
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class ImageGrabCapture(CaptureBackend):
+    """
+    Captures the screen with PIL. Works everywhere ImageGrab does, but PIL always creates a new image.
+    """
+    def capture(self, bbox: Tuple[int, int, int, int]) -> np.ndarray:
+        screen = np.array(ImageGrab.grab(bbox=bbox))
+        with tracer.span('color conversion'):
+            # Convert in place instead of allocating one more window sized image
+            return cv2.cvtColor(screen, cv2.COLOR_RGB2BGR, dst=screen)
+
+
+class MssCapture(CaptureBackend):
+    """
+    Captures the screen with mss, which uses the native screen APIs (X11 shared memory on Linux). The BGRA frame is
+    read without copying and converted into a preallocated BGR buffer.
+    """
+    def __init__(self):
+        if mss is None:
+            raise ValueError('mss capture needs the mss package')
+        # mss connections can't be shared between the threads (e.g. the scan and the calibration), neither the buffers
+        self._local = threading.local()
+        # All threads' connections, so close() called from any thread could close them
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def capture(self, bbox: Tuple[int, int, int, int]) -> np.ndarray:
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = mss.mss()
+            self._local.buffer = None
+            with self._connections_lock:
+                self._connections.append(self._local.connection)
+        left, top, right, bottom = bbox
+        shot = self._local.connection.grab({'left': left, 'top': top, 'width': right - left, 'height': bottom - top})
+        frame = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        if self._local.buffer is None or self._local.buffer.shape[:2] != frame.shape[:2]:
+            self._local.buffer = np.empty((shot.height, shot.width, 3), dtype=np.uint8)
+        with tracer.span('color conversion'):
+            return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR, dst=self._local.buffer)
+
+    def close(self) -> None:
+        """
+        Close the connections of all threads. The backend must not capture anymore after that.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+
+class ReplayCapture(CaptureBackend):
+    """
+    Replays saved full screen screenshots or video recordings instead of capturing the screen, so the scanner runs
+    without a display. Every capture returns the next frame and the replay starts over after the last one.
+    """
+    VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.webm')
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+    def __init__(self, path: str):
+        if os.path.isdir(path):
+            self._sources = sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(ReplayCapture.IMAGE_EXTENSIONS + ReplayCapture.VIDEO_EXTENSIONS))
+        else:
+            self._sources = [path]
+        if len(self._sources) == 0:
+            raise ValueError(f'Nothing to replay in {path}')
+        self._index = 0
+        self._video = None
+        self._frame = None
+        self._lock = threading.Lock()
+
+    def capture(self, bbox: Tuple[int, int, int, int]) -> np.ndarray:
+        with self._lock:
+            frame = self._next_frame()
+        left, top, right, bottom = bbox
+        # OpenCV matches the views of the frame as they are, there is no need to copy the window
+        return frame[top:bottom, left:right]
+
+    def _next_frame(self) -> np.ndarray:
+        # Every source could take two rounds, one to open the video and one to read it
+        for _ in range(2 * len(self._sources) + 1):
+            if self._video is not None:
+                # Reuse the previous frame buffer for the video frames
+                ok, frame = self._video.read(self._frame)
+                if ok:
+                    self._frame = frame
+                    return frame
+                self._video.release()
+                self._video = None
+                self._advance()
+                continue
+            source = self._sources[self._index]
+            if source.lower().endswith(ReplayCapture.VIDEO_EXTENSIONS):
+                self._video = cv2.VideoCapture(source)
+                continue
+            self._advance()
+            frame = cv2.imread(source, cv2.IMREAD_COLOR)
+            if frame is not None:
+                return frame
+        raise OSError('No readable frames to replay')
+
+    def _advance(self) -> None:
+        self._index = (self._index + 1) % len(self._sources)
+
+    def close(self) -> None:
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+
+def create_capture_backend(name: str) -> CaptureBackend:
+    """
+    Create the capture backend by its settings name: 'imagegrab', 'mss' or 'replay:<file or directory>'. Raises
+    ValueError if the backend is unknown or unavailable.
+    """
+    if name == 'imagegrab':
+        return ImageGrabCapture()
+    if name == 'mss':
+        return MssCapture()
+    if name.startswith('replay:'):
+        return ReplayCapture(name[len('replay:'):])
+    raise ValueError(f'Unknown capture backend {name}')
+
+
+class ImageScanner:
+    """
+    Implements scanning algorithm with OpenCV. Maintans the scanning window to speed up the scanning.
+    """
+    # Number of pixels around every grid cell to search for the template in grid mode
+    GRID_CELL_MARGIN = 2
+    # How much the threshold for the coarse candidates is lowered in pyramid mode per unit of the downscale factor.
+    # Downscaling blurs the details, so the similar items are harder to tell apart at the coarse level.
+    PYRAMID_THRESHOLD_MARGIN = 0.12
+    # The same for the search at the working size. The icons are always downsampled to the same size there, so they
+    # lose about the same confidence on any screen.
+    WORKING_THRESHOLD_MARGIN = 0.3
+    # Downscale factor of the cascade search when neither the pyramid factor nor the working size is coarser
+    CASCADE_FACTOR = 2.0
+    # Size of the downsampled cell used as its fingerprint and the largest per pixel difference of an unchanged cell
+    CELL_FINGERPRINT_SIZE = 8
+    CELL_FINGERPRINT_TOLERANCE = 6
+    # The scale bank searches the scale again when a scan finds less than this part of the items found before
+    SCALE_BANK_QUALITY_DROP = 0.5
+
+    def __init__(self, screen_width: int, screen_height: int, items_map: ArchnemesisItemsMap):
+        self._screen_width = screen_width
+        self._screen_height = screen_height
+        self._scanner_window_size = tuple(map(int, [0.1 * screen_height, 0.3 * screen_height, 0.41 * screen_height, 0.41 * screen_height]))
+        self._items_map = items_map
+        self._confidence_threshold = 0.94
+        self._grid_mode = False
+        self._grid = None
+        self._grid_scale = None
+        # Fingerprint and classification of every grid cell from the previous scans
+        self._cell_cache = dict()
+        self._classifier = None
+        self._classifier_scale = None
+        # OpenCV releases the GIL while matching, so the templates could be matched concurrently
+        self._workers = os.cpu_count() or 1
+        self._thread_pool = None
+        # Pyramid mode is disabled unless the downscale factor is greater than 1
+        self._pyramid_factor = 1.0
+        # Working icon size in pixels. Larger icons are matched downsampled to it, so the scan cost stays about the same
+        # on any screen resolution. 0 disables it.
+        self._working_size = 0
+        self._coarse_templates_key = None
+        self._coarse_templates_cache = None
+        # Cascade mode matches the clusters of similar templates on the downscaled screen first
+        self._cascade = False
+        self._cascade_stats = dict()
+        self._template_cascade_key = None
+        self._template_cascade_cache = None
+        # Radius of the scale bank in source image pixels, 0 disables it
+        self._scale_bank = 0
+        self._scale_bank_cache = None
+        # The scale the bank has chosen and the number of the items found with it. The scale is searched again when
+        # the number drops, None means it's not known yet.
+        self._bank_scale = None
+        self._bank_hits = None
+        self._capture_backend = ImageGrabCapture()
+
+    def scan(self, progress: 'ScanProgress' = None) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Capture the scanning window and find all items in it. Raises ScanCancelled if the progress gets cancelled.
+        """
+        return self.scan_image(self.capture(), progress)
+
+    def capture(self) -> np.ndarray:
+        """
+        Capture the scanning window as a BGR image. The image is only valid until the next capture.
+        """
+        bbox = (self._scanner_window_size[0], self._scanner_window_size[1], self._scanner_window_size[0] + self._scanner_window_size[2], self._scanner_window_size[1] + self._scanner_window_size[3])
+        with tracer.span('capture', bbox=bbox):
+            return self._capture_backend.capture(bbox)
+
+    def scan_image(self, screen: np.ndarray, progress: 'ScanProgress' = None) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Find all items in the BGR image of the scanning window. The locations are relative to the window.
+        """
+        if progress is None:
+            progress = ScanProgress()
+        progress.check()
+
+        with tracer.span('scan', grid_mode=self._grid_mode, pyramid_factor=self._search_factor()):
+            if self._scale_bank > 0:
+                results = self._scan_with_scale_bank(screen, progress)
+            else:
+                results = self._scan_image(screen, progress)
+        tracer.count('hits', {item: len(locations) for item, locations in results.items()})
+        return results
+
+    def _scan_with_scale_bank(self, screen: np.ndarray, progress: 'ScanProgress') -> Dict[str, List[Tuple[int, int]]]:
+        selected = self._bank_hits is None
+        if selected:
+            self._select_scale(screen, progress)
+        results = self._scan_image(screen, progress)
+        hits = sum(len(locations) for locations in results.values())
+        if not selected and (hits == 0 or hits < self._bank_hits * ImageScanner.SCALE_BANK_QUALITY_DROP):
+            # The match quality dropped, the scale might have changed
+            if self._select_scale(screen, progress):
+                results = self._scan_image(screen, progress)
+                hits = sum(len(locations) for locations in results.values())
+        self._bank_hits = hits if hits > 0 else None
+        return results
+
+    def _select_scale(self, screen: np.ndarray, progress: 'ScanProgress') -> bool:
+        """
+        Find the scale with the scale bank and switch the items map to it. Returns True if the scale has changed.
+        """
+        bank = self._get_scale_bank()
+        with tracer.span('select scale') as span:
+            scale = bank.select(screen, self._confidence_threshold, lambda function, values: self._map(function, values, progress))
+            span.set(scale=scale)
+        size = lambda scale: int(ScaleBank.SOURCE_IMAGE_SIZE * scale)
+        # The scales of the same scaled size give the same scan images
+        if scale is None or size(scale) == size(self._items_map.scale):
+            return False
+        self._bank_scale = scale
+        self._items_map.scale = scale
+        return True
+
+    def _get_scale_bank(self) -> ScaleBank:
+        bank = self._scale_bank_cache
+        # The bank is centered at the scale set from outside, not at the one it has chosen itself
+        if bank is None or self._items_map.scale not in (bank.center_scale, self._bank_scale):
+            with tracer.span('build scale bank', radius=self._scale_bank):
+                bank = ScaleBank(self._items_map, self._items_map.scale, self._scale_bank)
+            self._scale_bank_cache = bank
+            self._bank_scale = None
+        return bank
+
+    def _scan_image(self, screen: np.ndarray, progress: 'ScanProgress') -> Dict[str, List[Tuple[int, int]]]:
+        if not self._grid_mode:
+            return self._scan_window(screen, progress)
+        if self._grid is None or self._grid_scale != self._items_map.scale:
+            # Find the grid with one full window scan and reuse it until the window or the scale changes
+            results = self._scan_window(screen, progress)
+            self._grid = InventoryGrid.from_detections(results, self._items_map.image_size[0], screen.shape[1::-1], self.template_size())
+            self._cell_cache = dict()
+            self._grid_scale = self._items_map.scale
+            return results
+        return self._scan_grid(screen, progress)
+
+    def _scan_window(self, screen: np.ndarray, progress: 'ScanProgress') -> Dict[str, List[Tuple[int, int]]]:
+        radius = self._suppression_radius()
+        detections = []
+
+        if self._cascade:
+            self._scan_cascade(screen, radius, detections, progress)
+        else:
+            if self._search_factor() > 1:
+                coarse_screen = ImageScanner.downscale(screen, self._search_factor())
+                coarse_templates = self._coarse_templates()
+                match = lambda item: self._match_item_pyramid(screen, coarse_screen, coarse_templates[item], item, radius)
+            else:
+                match = lambda item: self._match_item(screen, item, radius)
+
+            # The executor preserves the items order so the results are merged deterministically
+            for item, _, peaks in self._map(match, self._items_map.items(), progress):
+                detections.extend((item, location, peak_confidence) for location, peak_confidence in peaks)
+        with tracer.span('suppress overlapping', detections=len(detections)):
+            return ImageScanner.suppress_overlapping(detections, radius)
+
+    def _scan_cascade(self, screen: np.ndarray, radius: int, detections: list, progress: 'ScanProgress') -> None:
+        start = time.perf_counter()
+        cascade = self._template_cascade()
+        coarse_screen = ImageScanner.downscale(screen, self._search_factor())
+        match = lambda cluster: self._match_cluster(screen, coarse_screen, cluster, radius)
+        pruned = []
+        coarse_ms = 0.0
+        for cluster_ms, cluster_results in self._map(match, cascade.clusters, progress):
+            coarse_ms += cluster_ms
+            for item, best, peaks in cluster_results:
+                if best[2] < 0:
+                    pruned.append(item)
+                detections.extend((item, location, peak_confidence) for location, peak_confidence in peaks)
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        items = sum(len(cluster.items) for cluster in cascade.clusters)
+        self._cascade_stats = {
+            'items': items,
+            'clusters': len(cascade.clusters),
+            'pruned': len(pruned),
+            'pruned_items': pruned,
+            'elapsed_ms': round(elapsed_ms, 3),
+            # Every cluster saves the downscaled matches of its other members, estimated by the average cluster match
+            'saved_ms': round(coarse_ms / len(cascade.clusters) * (items - len(cascade.clusters)), 3) if cascade.clusters else 0.0,
+        }
+        tracer.count('cascade', {'clusters': len(cascade.clusters), 'pruned': len(pruned)})
+
+    def _match_item(self, screen: np.ndarray, item: str, radius: int):
+        with tracer.span('match', item=item) as span:
+            heat_map = cv2.matchTemplate(screen, self._items_map.get_scan_image(item), cv2.TM_CCOEFF_NORMED)
+            _, confidence, _, (x, y) = cv2.minMaxLoc(heat_map)
+            span.set(x=x, y=y, confidence=confidence)
+        if confidence < self._confidence_threshold:
+            return (item, (x, y, confidence), [])
+        with tracer.span('find peaks', item=item):
+            return (item, (x, y, confidence), ImageScanner.find_peaks(heat_map, self._confidence_threshold, radius))
+
+    def _match_item_pyramid(self, screen: np.ndarray, coarse_screen: np.ndarray, coarse_template: np.ndarray, item: str, radius: int):
+        """
+        Match the downscaled template against the downscaled screen and verify the candidates at the full resolution
+        """
+        factor = self._search_factor()
+        with tracer.span('coarse match', item=item):
+            coarse_heat_map = cv2.matchTemplate(coarse_screen, coarse_template, cv2.TM_CCOEFF_NORMED)
+        candidates = [location for location, _ in ImageScanner.find_peaks(coarse_heat_map, self._coarse_threshold(), max(int(radius / factor), 1))]
+        best, peaks = self._verify_candidates(screen, item, candidates)
+        return (item, best, peaks)
+
+    def _coarse_threshold(self) -> float:
+        if self._working_factor() > self._pyramid_factor:
+            return self._confidence_threshold - ImageScanner.WORKING_THRESHOLD_MARGIN
+        return self._confidence_threshold - ImageScanner.PYRAMID_THRESHOLD_MARGIN * self._search_factor()
+
+    def _verify_candidates(self, screen: np.ndarray, item: str, candidates: List[Tuple[int, int]]):
+        """
+        Match the full resolution template around the candidate locations of the downscaled screen. Returns the best
+        match and the matches above the threshold.
+        """
+        factor = self._search_factor()
+        template = self._items_map.get_scan_image(item)
+        # The candidate could be misplaced by one coarse pixel in any direction
+        margin = int(np.ceil(factor)) + 1
+
+        best = (0, 0, -1.0)
+        peaks = []
+        for coarse_x, coarse_y in candidates:
+            left = max(int(coarse_x * factor) - margin, 0)
+            top = max(int(coarse_y * factor) - margin, 0)
+            right = min(int(coarse_x * factor) + template.shape[1] + margin, screen.shape[1])
+            bottom = min(int(coarse_y * factor) + template.shape[0] + margin, screen.shape[0])
+            roi = screen[top:bottom, left:right]
+            if roi.shape[0] < template.shape[0] or roi.shape[1] < template.shape[1]:
+                continue
+            with tracer.span('verify match', item=item):
+                heat_map = cv2.matchTemplate(roi, template, cv2.TM_CCOEFF_NORMED)
+                _, confidence, _, (x, y) = cv2.minMaxLoc(heat_map)
+            if confidence > best[2]:
+                best = (left + x, top + y, confidence)
+            if confidence >= self._confidence_threshold:
+                peaks.append(((left + x, top + y), float(confidence)))
+        return (best, peaks)
+
+    def _match_cluster(self, screen: np.ndarray, coarse_screen: np.ndarray, cluster: 'TemplateCluster', radius: int):
+        """
+        Match the cluster's mean template against the downscaled screen and verify every member at its candidates
+        """
+        factor = self._search_factor()
+        start = time.perf_counter()
+        with tracer.span('cluster match', items=len(cluster.items)):
+            coarse_heat_map = cv2.matchTemplate(coarse_screen, cluster.template, cv2.TM_CCOEFF_NORMED)
+        coarse_ms = (time.perf_counter() - start) * 1000
+        # A member matches its cluster's template a bit worse than itself
+        threshold = self._coarse_threshold() - (1 - cluster.similarity)
+        candidates = [location for location, _ in ImageScanner.find_peaks(coarse_heat_map, threshold, max(int(radius / factor), 1))]
+        if len(candidates) == 0:
+            return (coarse_ms, [(item, (0, 0, -1.0), []) for item in cluster.items])
+        results = []
+        for item in cluster.items:
+            best, peaks = self._verify_candidates(screen, item, candidates)
+            results.append((item, best, peaks))
+        return (coarse_ms, results)
+
+    def _template_cascade(self) -> 'TemplateCascade':
+        key = (self._items_map.scale, self._search_factor())
+        if self._template_cascade_key != key:
+            self._template_cascade_cache = TemplateCascade(self._coarse_templates())
+            self._template_cascade_key = key
+        return self._template_cascade_cache
+
+    def _coarse_templates(self) -> Dict[str, np.ndarray]:
+        factor = self._search_factor()
+        key = (self._items_map.scale, factor)
+        if self._coarse_templates_key != key:
+            self._coarse_templates_cache = {item: ImageScanner.downscale(self._items_map.get_scan_image(item), factor) for item in self._items_map.items()}
+            self._coarse_templates_key = key
+        return self._coarse_templates_cache
+
+    @staticmethod
+    def downscale(image: np.ndarray, factor: float) -> np.ndarray:
+        width = max(int(image.shape[1] / factor), 1)
+        height = max(int(image.shape[0] / factor), 1)
+        return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def find_peaks(heat_map: np.ndarray, threshold: float, radius: int) -> List[Tuple[Tuple[int, int], float]]:
+        """
+        Collapse every cluster of matches above the threshold to its local maximum within the radius
+        """
+        local_max = cv2.dilate(heat_map, cv2.getStructuringElement(cv2.MORPH_RECT, (2 * radius + 1, 2 * radius + 1)))
+        ys, xs = np.nonzero((heat_map >= threshold) & (heat_map >= local_max))
+        confidences = heat_map[ys, xs]
+        # Flat maximums produce several equal peaks next to each other, keep only the first one of them
+        order = np.argsort(-confidences, kind='stable')
+        peaks = []
+        for i in order:
+            if all(abs(xs[i] - x) > radius or abs(ys[i] - y) > radius for (x, y), _ in peaks):
+                peaks.append(((int(xs[i]), int(ys[i])), float(confidences[i])))
+        return peaks
+
+    @staticmethod
+    def suppress_overlapping(detections: List[Tuple[str, Tuple[int, int], float]], radius: int) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Resolve conflicts when several items claim the same slot by keeping the most confident one
+        """
+        results = dict()
+        if len(detections) == 0:
+            return results
+        locations = np.array([location for _, location, _ in detections])
+        confidences = np.array([confidence for _, _, confidence in detections])
+        suppressed = np.zeros(len(detections), dtype=bool)
+        for i in np.argsort(-confidences, kind='stable'):
+            if suppressed[i]:
+                continue
+            item, location, _ = detections[i]
+            results.setdefault(item, []).append(location)
+            suppressed |= np.all(np.abs(locations - locations[i]) <= radius, axis=1)
+        # Keep the locations in the reading order
+        for locations in results.values():
+            locations.sort(key=lambda location: (location[1], location[0]))
+        return results
+
+    def _suppression_radius(self) -> int:
+        # Items in the neighbouring slots are one image size apart, so anything closer is the same slot
+        return max(int(self._items_map.image_size[0] / 2), 1)
+
+    def _scan_grid(self, screen: np.ndarray, progress: 'ScanProgress') -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Classify every grid cell against all templates and keep the best match per cell
+        """
+        results = dict()
+        template_size = self.template_size()
+        cells = list(self._grid.cells())
+        fingerprints = {cell: ImageScanner.cell_fingerprint(screen, cell, template_size) for cell in cells}
+        # Only the cells which look different since the last scan have to be classified again
+        changed_cells = [cell for cell in cells if not self._is_cell_unchanged(cell, fingerprints[cell])]
+        tracer.count('changed cells', {'changed': len(changed_cells), 'unchanged': len(cells) - len(changed_cells)})
+        if len(changed_cells) > 0:
+            progress.add_steps(1)
+            progress.check()
+            with tracer.span('classify cells', cells=len(changed_cells)):
+                classified = self._cell_classifier().classify(screen, changed_cells, self._confidence_threshold, ImageScanner.GRID_CELL_MARGIN)
+            progress.advance()
+            for cell, (best_item, best_location, _) in zip(changed_cells, classified):
+                self._cell_cache[cell] = (fingerprints[cell], best_item, best_location)
+        for cell in cells:
+            _, best_item, best_location = self._cell_cache[cell]
+            if best_item is not None:
+                results.setdefault(best_item, []).append(best_location)
+        return results
+
+    def _cell_classifier(self) -> 'CellClassifier':
+        # The descriptors are sampled at the working size, which keeps the matrix multiply the same size on any screen
+        stride = max(CellClassifier.DESCRIPTOR_STRIDE, int(round(self._working_factor())))
+        if self._classifier is None or self._classifier_scale != (self._items_map.scale, stride):
+            self._classifier = CellClassifier(self._items_map, stride)
+            self._classifier_scale = (self._items_map.scale, stride)
+        return self._classifier
+
+    def _working_factor(self) -> float:
+        """
+        How much the icons are larger than the working size, 1 if the working size is disabled
+        """
+        if self._working_size <= 0:
+            return 1.0
+        return max(self._items_map.image_size[0] / self._working_size, 1.0)
+
+    def _search_factor(self) -> float:
+        """
+        Downscale factor of the coarse full window search: the pyramid factor or the working size, whichever is coarser
+        """
+        factor = max(self._pyramid_factor, self._working_factor())
+        if self._cascade and factor <= 1:
+            return ImageScanner.CASCADE_FACTOR
+        return factor
+
+    def _is_cell_unchanged(self, cell: Tuple[int, int], fingerprint: np.ndarray) -> bool:
+        cached = self._cell_cache.get(cell)
+        if cached is None:
+            return False
+        return int(np.abs(cached[0] - fingerprint).max()) <= ImageScanner.CELL_FINGERPRINT_TOLERANCE
+
+    @staticmethod
+    def cell_fingerprint(screen: np.ndarray, cell_location: Tuple[int, int], template_size: Tuple[int, int]) -> np.ndarray:
+        """
+        Cheap signature of the cell's content: the template sized area around the cell downsampled to a few pixels
+        """
+        x, y = cell_location
+        cell = screen[y:y + template_size[1], x:x + template_size[0]]
+        if cell.size == 0:
+            return np.zeros((0,), dtype=np.int16)
+        size = ImageScanner.CELL_FINGERPRINT_SIZE
+        return cv2.resize(cell, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def _map(self, function: Callable, values, progress: 'ScanProgress'):
+        """
+        Run the function for every value on the thread pool and return the results in the values order
+        """
+        values = list(values)
+        progress.add_steps(len(values))
+
+        def run(value):
+            progress.check()
+            result = function(value)
+            progress.advance()
+            return result
+        return self._executor().map(run, values)
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self._workers)
+        return self._thread_pool
+
+    def template_size(self) -> Tuple[int, int]:
+        shapes = [self._items_map.get_scan_image(item).shape[:2] for item in self._items_map.items()]
+        return (max(width for _, width in shapes), max(height for height, _ in shapes))
+
+    @property
+    def scanner_window_size(self) -> Tuple[int, int, int, int]:
+        return self._scanner_window_size
+
+    @scanner_window_size.setter
+    def scanner_window_size(self, value: Tuple[int, int, int, int]) -> None:
+        self._scanner_window_size = value
+        self._grid = None
+
+    @property
+    def confidence_threshold(self) -> float:
+        return self._confidence_threshold
+
+    @confidence_threshold.setter
+    def confidence_threshold(self, value) -> None:
+        self._confidence_threshold = value
+        self._cell_cache = dict()
+
+    @property
+    def items_map(self) -> ArchnemesisItemsMap:
+        return self._items_map
+
+    @property
+    def configured_scale(self) -> float:
+        """
+        Image scale set from outside. The scale bank switches the items map to the scale it has found, but the bank is
+        centered at this one, so it's the one to keep in the settings.
+        """
+        bank = self._scale_bank_cache
+        if bank is not None and self._bank_scale is not None and self._items_map.scale == self._bank_scale:
+            return bank.center_scale
+        return self._items_map.scale
+
+    @property
+    def cascade(self) -> bool:
+        return self._cascade
+
+    @cascade.setter
+    def cascade(self, value: bool) -> None:
+        self._cascade = value
+
+    @property
+    def scale_bank(self) -> int:
+        return self._scale_bank
+
+    @scale_bank.setter
+    def scale_bank(self, radius: int) -> None:
+        if radius != self._scale_bank:
+            # Go back to the configured scale, the next bank is centered at it
+            self._items_map.scale = self.configured_scale
+            self._scale_bank = radius
+            self._scale_bank_cache = None
+            self._bank_hits = None
+
+    @property
+    def cascade_stats(self) -> Dict[str, Any]:
+        """
+        Statistics of the last cascade scan: the number of the items and the clusters they were matched as, the items
+        pruned without a single full resolution match, the scan time and the estimated time saved, in ms
+        """
+        return self._cascade_stats
+
+    @property
+    def working_size(self) -> int:
+        return self._working_size
+
+    @working_size.setter
+    def working_size(self, value: int) -> None:
+        self._working_size = value
+        self._cell_cache = dict()
+
+    @property
+    def capture_backend(self) -> CaptureBackend:
+        return self._capture_backend
+
+    @capture_backend.setter
+    def capture_backend(self, value: CaptureBackend) -> None:
+        self._capture_backend.close()
+        self._capture_backend = value
+
+    @property
+    def grid_mode(self) -> bool:
+        return self._grid_mode
+
+    @grid_mode.setter
+    def grid_mode(self, value: bool) -> None:
+        self._grid_mode = value
+        self._grid = None
+
+    @property
+    def grid(self):
+        return self._grid
+
+    @grid.setter
+    def grid(self, value: 'InventoryGrid') -> None:
+        """
+        Use the known grid (e.g. from the calibration) for the current scale instead of searching for it
+        """
+        self._grid = value
+        self._grid_scale = self._items_map.scale
+        self._cell_cache = dict()
+
+    @property
+    def pyramid_factor(self) -> float:
+        return self._pyramid_factor
+
+    @pyramid_factor.setter
+    def pyramid_factor(self, value: float) -> None:
+        self._pyramid_factor = value
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @workers.setter
+    def workers(self, value: int) -> None:
+        if value == self._workers:
+            return
+        self._workers = value
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+            self._thread_pool = None
+
+    @property
+    def screen_width(self) -> int:
+        return self._screen_width
+
+    @property
+    def screen_height(self) -> int:
+        return self._screen_height
+
+
+class InventoryWatcher:
+    """
+    Decides when the watch mode should scan. Every poll reduces the captured scanner window to a tiny fingerprint.
+    The inventory counts as open when the fingerprint outside of the item cells matches the panel learned from the
+    last scan which found items (until then it counts as open), and as closed while the window still shows what a
+    scan found nothing in. A scan is due when the open inventory has settled, i.e. didn't change for a few polls, on
+    different contents than the last scan saw. While the inventory is closed the poll interval doubles up to the
+    maximum, and every scan which finds nothing doubles the polls needed to settle, so the idle screens which are
+    not the inventory get scanned less and less often.
+    """
+    # Default time between the polls in ms
+    POLL_INTERVAL = 250
+    # The closed inventory is polled at most this many times slower, and needs at most this many times more polls to
+    # settle after the empty scans
+    MAX_BACKOFF = 8
+    FINGERPRINT_SIZE = 32
+    # Largest difference of a fingerprint pixel which still counts as the same
+    FINGERPRINT_TOLERANCE = 12
+    # Part of the fingerprint pixels which must differ to count as a change, so the mouse cursor doesn't
+    CHANGE_FRACTION = 0.005
+    # Part of the panel pixels which must match the learned panel for the inventory to count as open
+    PANEL_MATCH = 0.8
+    # Number of the unchanged polls after which the inventory counts as settled
+    SETTLE_POLLS = 2
+
+    def __init__(self, interval: int = POLL_INTERVAL):
+        self._lock = threading.Lock()
+        self._interval = interval
+        self._poll_interval = interval
+        self.enabled = False
+        self._previous = None
+        self._unchanged_polls = 0
+        self._scanned = None
+        self._empty = None
+        self._empty_scans = 0
+        self._panel = None
+        self._panel_mask = None
+
+    @staticmethod
+    def fingerprint(screen: np.ndarray) -> np.ndarray:
+        size = InventoryWatcher.FINGERPRINT_SIZE
+        return cv2.resize(screen, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    @staticmethod
+    def _changed(fingerprint: np.ndarray, other: Optional[np.ndarray]) -> bool:
+        if other is None:
+            return True
+        differs = (np.abs(fingerprint - other).max(axis=2) > InventoryWatcher.FINGERPRINT_TOLERANCE).mean()
+        return bool(differs > InventoryWatcher.CHANGE_FRACTION)
+
+    def update(self, fingerprint: np.ndarray) -> bool:
+        """
+        Take the fingerprint of the polled scanner window and tell whether it should be scanned now
+        """
+        with self._lock:
+            if InventoryWatcher._changed(fingerprint, self._previous):
+                self._unchanged_polls = 0
+            else:
+                self._unchanged_polls += 1
+            self._previous = fingerprint
+
+            if not self._is_open(fingerprint):
+                self._poll_interval = min(self._poll_interval * 2, self._interval * InventoryWatcher.MAX_BACKOFF)
+                return False
+            self._poll_interval = self._interval
+            settle_polls = InventoryWatcher.SETTLE_POLLS * min(2 ** self._empty_scans, InventoryWatcher.MAX_BACKOFF)
+            return self._unchanged_polls >= settle_polls and InventoryWatcher._changed(fingerprint, self._scanned)
+
+    def scanned(self, fingerprint: np.ndarray, results: Dict[str, List[Tuple[int, int]]], template_size: Tuple[int, int], window_size: Tuple[int, int]) -> None:
+        """
+        Remember the scanned contents. The scan with items teaches how the open panel looks around them.
+        """
+        with self._lock:
+            self._scanned = fingerprint
+            if len(results) == 0:
+                self._empty = fingerprint
+                self._empty_scans += 1
+                return
+            self._empty = None
+            self._empty_scans = 0
+            size = InventoryWatcher.FINGERPRINT_SIZE
+            scale_x, scale_y = size / window_size[0], size / window_size[1]
+            mask = np.ones((size, size), dtype=bool)
+            for locations in results.values():
+                for x, y in locations:
+                    # One more fingerprint pixel around the cell, which INTER_AREA blends with it
+                    left, top = max(int(x * scale_x) - 1, 0), max(int(y * scale_y) - 1, 0)
+                    right, bottom = int((x + template_size[0]) * scale_x) + 2, int((y + template_size[1]) * scale_y) + 2
+                    mask[top:bottom, left:right] = False
+            if mask.any():
+                self._panel = fingerprint
+                self._panel_mask = mask
+
+    def _is_open(self, fingerprint: np.ndarray) -> bool:
+        if self._empty is not None and not InventoryWatcher._changed(fingerprint, self._empty):
+            return False
+        if self._panel is None:
+            return True
+        matches = np.abs(fingerprint - self._panel).max(axis=2) <= InventoryWatcher.FINGERPRINT_TOLERANCE
+        return bool(matches[self._panel_mask].mean() >= InventoryWatcher.PANEL_MATCH)
+
+    def reset(self) -> None:
+        """
+        Forget the learned panel, e.g. when the scanner window changes
+        """
+        with self._lock:
+            self._previous = None
+            self._unchanged_polls = 0
+            self._scanned = None
+            self._empty = None
+            self._empty_scans = 0
+            self._panel = None
+            self._panel_mask = None
+            self._poll_interval = self._interval
+
+    @property
+    def interval(self) -> int:
+        return self._interval
+
+    @interval.setter
+    def interval(self, value: int) -> None:
+        with self._lock:
+            self._interval = value
+            self._poll_interval = value
+
+    @property
+    def poll_interval(self) -> int:
+        """
+        Time until the next poll in ms, longer while the inventory is closed
+        """
+        return self._poll_interval
+
+
+def scan_screenshot(scanner: ImageScanner, planner: 'RecipePlanner', screen: np.ndarray, combos: List[List[str]]) -> Dict[str, Any]:
+    """
+    Scan the scanner window part of the full screen BGR screenshot and plan the recipes. Returns the JSON ready
+    results with the locations in the screen coordinates, like the overlay shows them.
+    """
+    screen_height, screen_width = screen.shape[:2]
+    x, y, width, height = scanner.scanner_window_size
+    results = scanner.scan_image(np.ascontiguousarray(screen[y:y + height, x:x + width]))
+    items = {item: [(int(x + location[0]), int(y + location[1])) for location in locations] for item, locations in results.items()}
+    plan = planner.plan(items, combos)
+    return {
+        'screen_size': [screen_width, screen_height],
+        'scale': scanner.items_map.scale,
+        'counts': {item: len(locations) for item, locations in items.items()},
+        'items': items,
+        'recipes': [{'item': item, 'locations': locations, 'in_inventory': exists} for item, locations, exists in plan.recipes],
+        'completed_combos': plan.completed_combos,
+        'shortfall': plan.shortfall,
+    }
+
+
+def calculate_default_scale(screen_width: int, screen_height: int) -> float:
+    """
+    TODO: validate the math for non 16:9 resolutions (e.g. ultrawide monitors)
+    """
+
+    # Assume that all source images have 78x78 size
+    source_image_height = 78.0
+
+    # Take 0.90 as a golden standard for 2560x1440 resolution and calculate
+    # scales for other resolutions based on that
+    constant = 1440.0 / (source_image_height * 0.91)
+    scale = screen_height / (source_image_height * constant)
+
+    return scale
+
+
+def check_combos(combos: Any) -> List[List[str]]:
+    """
+    Make sure the combos are a list of lists of the known item names, the same format as in settings.ini. Raises
+    ValueError otherwise.
+    """
+    if not isinstance(combos, list) or not all(isinstance(combo, list) and all(isinstance(item, str) for item in combo) for combo in combos):
+        raise ValueError('combos must be a JSON list of lists of item names')
+    known = {item for item, _ in ArchnemesisItemsMap.ARCH_ITEMS}
+    unknown = sorted({item for combo in combos for item in combo if item not in known})
+    if unknown:
+        raise ValueError(f'unknown items in the combos: {", ".join(unknown)}')
+    return combos
+
+
+def parse_combos(value: str) -> List[List[str]]:
+    try:
+        return check_combos(json.loads(value))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_resolution(value: str) -> Tuple[int, int]:
+    try:
+        width, height = map(int, value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected WIDTHxHEIGHT')
+    return (width, height)
+
+
+def parse_window(value: str) -> Tuple[int, int, int, int]:
+    try:
+        x, y, width, height = map(int, value.replace(',', ' ').split())
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected "x, y, width, height"')
+    return (x, y, width, height)
+
+
+def add_scanner_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Options of the headless tools which configure their scanners, see create_scanner
+    """
+    parser.add_argument('--scale', type=float, default=None, help='image scale (default: calculated from the screenshot resolution)')
+    parser.add_argument('--window', type=parse_window, default=None, help='scanner window "x, y, width, height" (default: calculated from the screenshot resolution)')
+    parser.add_argument('--threshold', type=float, default=0.94, help='confidence threshold (default: 0.94)')
+    parser.add_argument('--working-size', type=int, default=0, help='icon size in pixels to match at, 0 disables it (default: 0)')
+    parser.add_argument('--scale-bank', type=int, default=0, help='find the scale within this many source image pixels around the image scale, 0 disables it (default: 0)')
+    parser.add_argument('--combos', type=parse_combos, default=DEFAULT_COMBOS, help='JSON list of the combos to evaluate, the same format as in settings.ini')
+
+
+def options_scale(options: argparse.Namespace, screen_width: int, screen_height: int) -> float:
+    return options.scale if options.scale is not None else calculate_default_scale(screen_width, screen_height)
+
+
+def create_scanner(screen_width: int, screen_height: int, options: argparse.Namespace, workers: int, items_map: Optional[ArchnemesisItemsMap] = None) -> ImageScanner:
+    """
+    Scanner of the screenshots configured by the options of add_scanner_arguments. A new items map is created if
+    none is given.
+    """
+    if items_map is None:
+        items_map = ArchnemesisItemsMap(options_scale(options, screen_width, screen_height))
+    scanner = ImageScanner(screen_width, screen_height, items_map)
+    scanner.workers = workers
+    scanner.confidence_threshold = options.threshold
+    scanner.working_size = options.working_size
+    scanner.scale_bank = options.scale_bank
+    if options.window is not None:
+        scanner.scanner_window_size = options.window
+    return scanner
+
+
+class CalibrationProfile:
+    """
+    Result of the calibration for one screen resolution: the image scale, the scanning window around the inventory
+    grid and the grid inside that window
+    """
+    def __init__(self, scale: float, scanner_window_size: Tuple[int, int, int, int], grid: InventoryGrid):
+        self._scale = scale
+        self._scanner_window_size = scanner_window_size
+        self._grid = grid
+
+    def to_dict(self) -> Dict[str, str]:
+        return {
+            'image_scale': str(self._scale),
+            'scanner_window': str(self._scanner_window_size),
+            'grid_origin': json.dumps([round(float(value), 3) for value in self._grid.origin]),
+            'grid_pitch': json.dumps([round(float(value), 3) for value in self._grid.pitch]),
+            'grid_size': json.dumps([int(self._grid.rows), int(self._grid.columns)]),
+        }
+
+    @staticmethod
+    def from_dict(values) -> 'CalibrationProfile':
+        """
+        Raises KeyError or ValueError if the values are incomplete or broken
+        """
+        scanner_window_size = tuple(map(int, values['scanner_window'].replace('(', '').replace(')', '').replace(',', '').split()))
+        if len(scanner_window_size) != 4:
+            raise ValueError('Scanner window needs 4 values')
+        rows, columns = json.loads(values['grid_size'])
+        grid = InventoryGrid(tuple(json.loads(values['grid_origin'])), tuple(json.loads(values['grid_pitch'])), int(rows), int(columns))
+        return CalibrationProfile(float(values['image_scale']), scanner_window_size, grid)
+
+    @property
+    def scale(self) -> float:
+        return self._scale
+
+    @property
+    def scanner_window_size(self) -> Tuple[int, int, int, int]:
+        return self._scanner_window_size
+
+    @property
+    def grid(self) -> InventoryGrid:
+        return self._grid
+
+
+class Calibrator:
+    """
+    Finds the image scale and the inventory grid in a capture of the scanning window, so they don't have to be
+    tuned by hand. The scales around the default one are scored by how well the best matching items fit at the
+    coarse resolution, the best of them is refined at the full resolution with those items only and then gets a full
+    scan to fit the grid.
+    """
+    # Relative range and number of the scales tried around the default one
+    SCALE_RANGE = 0.2
+    SCALE_STEPS = 9
+    # The archnemesis inventory has 8x8 slots
+    GRID_SIZE = 8
+    # Pixels added around the grid to the calibrated scanning window
+    WINDOW_MARGIN = 4
+
+    def __init__(self, screen_width: int, screen_height: int, items_map: ArchnemesisItemsMap, confidence_threshold: float):
+        self._screen_width = screen_width
+        self._screen_height = screen_height
+        self._items_map = items_map
+        self._confidence_threshold = confidence_threshold
+        self._workers = os.cpu_count() or 1
+
+    def calibrate(self, screen: np.ndarray, scanner_window_size: Tuple[int, int, int, int], default_scale: float, progress: ScanProgress = None) -> Optional[CalibrationProfile]:
+        """
+        Calibrate on the BGR capture of the scanning window. Returns None if the inventory grid wasn't found.
+        """
+        if progress is None:
+            progress = ScanProgress()
+        progress.add_steps(Calibrator.SCALE_STEPS + 1)
+        items = [item for item in self._items_map.items()]
+
+        # The coarse search and the scoring are the same as the scale bank's, see match_templates
+        coarse_screen = ImageScanner.downscale(screen, ScaleBank.SEARCH_FACTOR)
+        coarse_scores = dict()
+        for scale in np.linspace(default_scale * (1 - Calibrator.SCALE_RANGE), default_scale * (1 + Calibrator.SCALE_RANGE), Calibrator.SCALE_STEPS):
+            coarse_scores[float(scale)] = self._score(coarse_screen, items, float(scale), ScaleBank.SEARCH_FACTOR, progress)
+            progress.advance()
+        best_scale = max(coarse_scores, key=lambda scale: coarse_scores[scale][0])
+        if coarse_scores[best_scale][0] < 0:
+            return None
+
+        # The coarse matching can't tell the close scales apart, so refine around the best one with its best items.
+        # The scan images only change with their scaled size, so every size between the neighbours is tried once, in
+        # the middle of its scales (half a pixel up, like the scale bank), so no source image gets undersized.
+        step = 2 * Calibrator.SCALE_RANGE * default_scale / (Calibrator.SCALE_STEPS - 1)
+        best_items = coarse_scores[best_scale][1]
+        sizes = range(int(ScaleBank.SOURCE_IMAGE_SIZE * (best_scale - step)), int(ScaleBank.SOURCE_IMAGE_SIZE * (best_scale + step)) + 1)
+        progress.add_steps(len(sizes))
+        scores = dict()
+        for size in sizes:
+            scale = (size + 0.5) / ScaleBank.SOURCE_IMAGE_SIZE
+            scores[scale] = self._score(screen, best_items, scale, 1.0, progress)[0]
+            progress.advance()
+        best_scale = max(scores, key=scores.get)
+
+        # Scan at the best scale to find the grid
+        scanner = ImageScanner(self._screen_width, self._screen_height, ArchnemesisItemsMap(best_scale))
+        scanner.scanner_window_size = scanner_window_size
+        scanner.confidence_threshold = self._confidence_threshold
+        scanner.pyramid_factor = ScaleBank.SEARCH_FACTOR
+        results = scanner.scan_image(screen, progress)
+        template_size = scanner.template_size()
+        grid = InventoryGrid.from_detections(results, scanner.items_map.image_size[0], screen.shape[1::-1], template_size)
+        progress.advance()
+        if grid is None:
+            return None
+        return self._fit_window(grid, results, scanner_window_size, template_size, best_scale)
+
+    def _score(self, screen: np.ndarray, items: List[str], scale: float, factor: float, progress: ScanProgress) -> Tuple[float, List[str]]:
+        """
+        Mean confidence of the best matching items at the scale, and those items
+        """
+        progress.check()
+        create_template = lambda item: ImageScanner.downscale(self._items_map.create_scan_image(item, scale), factor)
+
+        with tracer.span('calibration score', scale=scale, factor=factor) as span:
+            # OpenCV releases the GIL, so the items are matched in parallel
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                templates = dict(zip(items, executor.map(create_template, items)))
+                score, matches = match_templates(screen, templates, ScaleBank.SCORED_ITEMS, executor.map)
+            span.set(score=score)
+        return (score, [item for _, item, _ in matches])
+
+    def _fit_window(self, grid: InventoryGrid, results: Dict[str, List[Tuple[int, int]]], scanner_window_size: Tuple[int, int, int, int], template_size: Tuple[int, int], scale: float) -> CalibrationProfile:
+        """
+        Shrink the scanning window to the inventory grid around the found items
+        """
+        locations = np.array([location for locations in results.values() for location in locations], dtype=np.float64)
+        first = []
+        count = []
+        for axis, cells in ((0, grid.columns), (1, grid.rows)):
+            indices = np.round((locations[:, axis] - grid.origin[axis]) / grid.pitch[axis]).astype(int)
+            # Keep the inventory sized part of the window which has all the found items in it
+            start = max(min(int(indices.min()), cells - Calibrator.GRID_SIZE), 0)
+            first.append(start)
+            count.append(int(min(cells - start, Calibrator.GRID_SIZE)))
+        margin = Calibrator.WINDOW_MARGIN
+        left = int(grid.origin[0] + first[0] * grid.pitch[0]) - margin
+        top = int(grid.origin[1] + first[1] * grid.pitch[1]) - margin
+        width = int((count[0] - 1) * grid.pitch[0]) + template_size[0] + 2 * margin
+        height = int((count[1] - 1) * grid.pitch[1]) + template_size[1] + 2 * margin
+        left, top = max(left, 0), max(top, 0)
+        window = (scanner_window_size[0] + left, scanner_window_size[1] + top, width, height)
+        calibrated_grid = InventoryGrid((grid.origin[0] + first[0] * grid.pitch[0] - left, grid.origin[1] + first[1] * grid.pitch[1] - top), grid.pitch, count[1], count[0])
+        return CalibrationProfile(scale, window, calibrated_grid)
+
+
+class RecipePlan:
+    """
+    Result of RecipePlanner.plan
+    """
+    def __init__(self, recipes: List[Tuple[str, List[Tuple[int, int]], bool]], completed_combos: int, shortfall: List[str]):
+        self._recipes = recipes
+        self._completed_combos = completed_combos
+        self._shortfall = shortfall
+
+    @property
+    def recipes(self) -> List[Tuple[str, List[Tuple[int, int]], bool]]:
+        """
+        Recipes which could be created right now: the created item, the locations of the ingredients and whether the
+        item already exists in the inventory. Finished combos are reported as the 'Combo' item.
+        """
+        return self._recipes
+
+    @property
+    def completed_combos(self) -> int:
+        return self._completed_combos
+
+    @property
+    def shortfall(self) -> List[str]:
+        """
+        Base items missing to complete the rest of the combos, one entry per missing item
+        """
+        return self._shortfall
+
+
+class RecipePlanner:
+    """
+    Plans the recipes for the combos on integer item counts. Everything derived from the recipes (the topological
+    order and the base items every item is made of) is precomputed once, so planning is cheap enough for every scan.
+    """
+    # Limit of the allocations tried when looking for the most combos, the best one found so far is used after that
+    SEARCH_LIMIT = 1000
+
+    def __init__(self, items_map: ArchnemesisItemsMap):
+        self._items = list(items_map.items())
+        self._index = {item: i for i, item in enumerate(self._items)}
+        self._recipes = [[] for _ in self._items]
+        for item, ingredients in items_map.recipes():
+            self._recipes[self._index[item]] = [self._index[ingredient] for ingredient in ingredients]
+        self._order = self._topological_order()
+        # Row i holds the number of every base item needed to create item i from scratch
+        self._leaves = np.zeros((len(self._items), len(self._items)), dtype=np.int64)
+        for i in self._order:
+            if self._recipes[i]:
+                for ingredient in self._recipes[i]:
+                    self._leaves[i] += self._leaves[ingredient]
+            else:
+                self._leaves[i, i] = 1
+
+    def _topological_order(self) -> List[int]:
+        """
+        Order the items so every ingredient goes before the items created from it
+        """
+        order = []
+        state = [0] * len(self._items)
+        for root in range(len(self._items)):
+            stack = [(root, False)]
+            while stack:
+                i, expanded = stack.pop()
+                if expanded:
+                    state[i] = 2
+                    order.append(i)
+                    continue
+                if state[i] != 0:
+                    if state[i] == 1:
+                        raise ValueError(f'Recipe cycle through {self._items[i]}')
+                    continue
+                state[i] = 1
+                stack.append((i, True))
+                stack.extend((ingredient, False) for ingredient in reversed(self._recipes[i]) if state[ingredient] != 2)
+        return order
+
+    def plan(self, inventory: Dict[str, List[Tuple[int, int]]], combos: List[List[str]]) -> RecipePlan:
+        """
+        Choose the combos to complete so that the most of them could be finished with the inventory, then use what's
+        left to make progress on the rest of them. The inventory is not modified. Unknown item names (e.g. typos in
+        the settings) can't be obtained, so their combos are never completed and the names go into the shortfall.
+        """
+        counts = np.zeros(len(self._items), dtype=np.int64)
+        for item, locations in inventory.items():
+            if item in self._index:
+                counts[self._index[item]] = len(locations)
+        unknown = [item for combo in combos for item in combo if item not in self._index]
+        obtainable = [all(item in self._index for item in combo) for combo in combos]
+        combos = [[self._index[item] for item in combo if item in self._index] for combo in combos]
+
+        # Group the equal combos so every distinct combo is only searched once
+        groups = []
+        for combo in [combo for combo, combo_obtainable in zip(combos, obtainable) if combo_obtainable]:
+            for group in groups:
+                if group[0] == combo:
+                    group[1] += 1
+                    break
+            else:
+                groups.append([combo, 1])
+        allocation = self._find_allocation(counts, groups)
+
+        steps = []
+        remaining = counts.copy()
+        for (combo, _), completed in zip(groups, allocation):
+            for _ in range(completed):
+                remaining = self._take_combo(remaining, combo, steps)
+        shortfall = []
+        left = list(allocation)
+        for combo, combo_obtainable in zip(combos, obtainable):
+            if combo_obtainable:
+                group = next(i for i, (group_combo, _) in enumerate(groups) if group_combo == combo)
+                if left[group] > 0:
+                    left[group] -= 1
+                    continue
+            for item in combo:
+                self._take_partially(remaining, item, steps, shortfall)
+        return RecipePlan(self._recipes_from_steps(steps, inventory, counts), sum(allocation), [self._items[i] for i in shortfall] + unknown)
+
+    def _find_allocation(self, counts: np.ndarray, groups: List[List]) -> List[int]:
+        """
+        Branch and bound over the number of completions of every distinct combo
+        """
+        multiplicities = np.array([multiplicity for _, multiplicity in groups], dtype=np.int64)
+        combo_leaves = np.array([self._leaves[combo].sum(axis=0) for combo, _ in groups], dtype=np.int64).reshape(len(groups), len(self._items))
+        required = combo_leaves > 0
+        budget = [RecipePlanner.SEARCH_LIMIT]
+
+        # Start with the greedy allocation which completes the cheapest combos first, it's usually close to the best
+        greedy = [0] * len(groups)
+        remaining = counts
+        for group in np.argsort(combo_leaves.sum(axis=1), kind='stable'):
+            while greedy[group] < multiplicities[group]:
+                taken = self._take_combo(remaining, groups[group][0], None)
+                if taken is None:
+                    break
+                remaining = taken
+                greedy[group] += 1
+        best = [sum(greedy), greedy]
+
+        def upper_bound(available: np.ndarray, start: int) -> int:
+            # Any item is made of its base items, so a combo can't be completed more times than they allow
+            possible = np.where(required[start:], available // np.maximum(combo_leaves[start:], 1), multiplicities.max()).min(axis=1, initial=multiplicities.max())
+            return int(np.minimum(multiplicities[start:], possible).sum())
+
+        def search(group: int, counts: np.ndarray, available: np.ndarray, allocation: List[int], completed: int) -> None:
+            if group == len(groups):
+                if completed > best[0]:
+                    best[0], best[1] = completed, list(allocation)
+                return
+            if budget[0] <= 0 or completed + upper_bound(available, group) <= best[0]:
+                return
+            budget[0] -= 1
+            states = [counts]
+            for _ in range(multiplicities[group]):
+                taken = self._take_combo(states[-1], groups[group][0], None)
+                if taken is None:
+                    break
+                states.append(taken)
+            # Try completing the earlier combos as many times as possible first
+            for completions in reversed(range(len(states))):
+                # Creating an item doesn't change the base items it's made of, so the combo always uses up the same ones
+                search(group + 1, states[completions], available - completions * combo_leaves[group], allocation + [completions], completed + completions)
+
+        search(0, counts, counts @ self._leaves, [], 0)
+        return best[1]
+
+    def _take_combo(self, counts: np.ndarray, combo: List[int], steps: Optional[List]) -> Optional[np.ndarray]:
+        """
+        Return the counts left after obtaining every combo item or None if it's not possible
+        """
+        counts = counts.copy()
+        combo_steps = []
+        taken = []
+        for item in combo:
+            step = self._take(counts, item, combo_steps)
+            if step is None:
+                return None
+            taken.append(step)
+        if steps is not None:
+            offset = len(steps)
+            steps.extend((action, item, [child + offset for child in children]) for action, item, children in combo_steps)
+            if all(combo_steps[step][0] == 'use' for step in taken):
+                # All the combo items are already in the inventory
+                steps.append(('combo', None, [step + offset for step in taken]))
+        return counts
+
+    def _take(self, counts: np.ndarray, item: int, steps: List) -> Optional[int]:
+        """
+        Take the item from the inventory or create it from its ingredients. Returns the index of the step
+        which provides the item or None if it's not possible.
+        """
+        if counts[item] > 0:
+            counts[item] -= 1
+            steps.append(('use', item, []))
+            return len(steps) - 1
+        if not self._recipes[item]:
+            return None
+        ingredients = []
+        for ingredient in self._recipes[item]:
+            step = self._take(counts, ingredient, steps)
+            if step is None:
+                return None
+            ingredients.append(step)
+        steps.append(('craft', item, ingredients))
+        return len(steps) - 1
+
+    def _take_partially(self, counts: np.ndarray, item: int, steps: List, shortfall: List[int]) -> Optional[int]:
+        """
+        Like _take, but keep everything found on the way reserved and record the missing base items
+        """
+        if counts[item] > 0:
+            counts[item] -= 1
+            steps.append(('use', item, []))
+            return len(steps) - 1
+        if not self._recipes[item]:
+            shortfall.append(item)
+            return None
+        ingredients = [self._take_partially(counts, ingredient, steps, shortfall) for ingredient in self._recipes[item]]
+        if any(step is None for step in ingredients):
+            return None
+        steps.append(('craft', item, ingredients))
+        return len(steps) - 1
+
+    def _recipes_from_steps(self, steps: List, inventory: Dict[str, List[Tuple[int, int]]], counts: np.ndarray) -> List[Tuple[str, List[Tuple[int, int]], bool]]:
+        # Hand out the item locations in the order the items were used
+        next_location = [0] * len(self._items)
+        locations = dict()
+        for i, (action, item, _) in enumerate(steps):
+            if action == 'use':
+                locations[i] = inventory[self._items[item]][next_location[item]]
+                next_location[item] += 1
+
+        recipes = []
+        for action, item, children in steps:
+            if action == 'combo':
+                recipes.append(('Combo', [locations[child] for child in children], False))
+            elif action == 'craft' and all(child in locations for child in children):
+                # Only the recipes made of the items which are already in the inventory could be created right now
+                recipes.append((self._items[item], [locations[child] for child in children], bool(counts[item] > 0)))
+        return recipes
+
+
+class ScanLedger:
+    """
+    Append-only SQLite log of the scans: when every scan happened, how many of every item it found and where (in the
+    screen coordinates), and which recipes were available. The database is in the WAL mode, so the queries never block
+    the writes. The scans are written on a background thread, which commits everything queued in one transaction, so
+    recording a scan only costs a queue put.
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS scans (id INTEGER PRIMARY KEY, timestamp REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS scans_timestamp ON scans (timestamp)',
+        'CREATE TABLE IF NOT EXISTS scan_items (scan_id INTEGER NOT NULL REFERENCES scans (id), item TEXT NOT NULL, count INTEGER NOT NULL, locations TEXT NOT NULL, PRIMARY KEY (scan_id, item)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS scan_items_item ON scan_items (item, scan_id)',
+        'CREATE TABLE IF NOT EXISTS scan_recipes (scan_id INTEGER NOT NULL REFERENCES scans (id), item TEXT NOT NULL, in_inventory INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS scan_recipes_scan ON scan_recipes (scan_id)',
+    ]
+    # Most scans committed in one transaction
+    BATCH_SIZE = 64
+
+    def __init__(self, path: str):
+        self._path = path
+        self._queue = queue.Queue()
+        # Guards the closed flag, so no scan is queued behind the close sentinel
+        self._closed_lock = threading.Lock()
+        self._closed = False
+        self._read_lock = threading.Lock()
+        self._read_connection = None
+        connection = self._connect()
+        with connection:
+            for statement in ScanLedger.SCHEMA:
+                connection.execute(statement)
+        self._writer = threading.Thread(target=self._write, args=(connection,), daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # WAL keeps the database consistent with the normal sync, only the last commits could be lost on a crash
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def record(self, results: Dict[str, List[Tuple[int, int]]], recipes: List[Tuple[str, List[Tuple[int, int]], bool]], timestamp: Optional[float] = None) -> None:
+        """
+        Queue the scan for writing. Never blocks. The scans recorded after the ledger is closed are ignored.
+        """
+        with self._closed_lock:
+            if not self._closed:
+                self._queue.put((time.time() if timestamp is None else timestamp, results, recipes))
+
+    def _write(self, connection: sqlite3.Connection) -> None:
+        closed = False
+        while not closed:
+            batch = [self._queue.get()]
+            while len(batch) < ScanLedger.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closed = any(scan is None for scan in batch)
+            scans = [scan for scan in batch if scan is not None]
+            try:
+                with connection:
+                    for timestamp, results, recipes in scans:
+                        scan_id = connection.execute('INSERT INTO scans (timestamp) VALUES (?)', (timestamp,)).lastrowid
+                        connection.executemany('INSERT INTO scan_items VALUES (?, ?, ?, ?)', [
+                            (scan_id, item, len(locations), json.dumps([[int(x), int(y)] for x, y in locations])) for item, locations in results.items()
+                        ])
+                        connection.executemany('INSERT INTO scan_recipes VALUES (?, ?, ?)', [(scan_id, item, int(exists)) for item, _, exists in recipes])
+            except sqlite3.Error as e:
+                print(f'Unable to write {len(scans)} scans into the ledger: {e}', file=sys.stderr)
+            for _ in batch:
+                self._queue.task_done()
+        connection.close()
+
+    def flush(self) -> None:
+        """
+        Wait until all the recorded scans are written
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Write all the recorded scans and close the database
+        """
+        with self._closed_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._writer.join()
+        with self._read_lock:
+            if self._read_connection is not None:
+                self._read_connection.close()
+                self._read_connection = None
+
+    def _query(self, sql: str, parameters: Tuple) -> List[Tuple]:
+        with self._read_lock:
+            if self._read_connection is None:
+                self._read_connection = self._connect()
+            return self._read_connection.execute(sql, parameters).fetchall()
+
+    def item_counts(self, item: str, since: float = 0.0, until: float = float('inf')) -> List[Tuple[float, int]]:
+        """
+        Count of the item in every scan between the timestamps, as (timestamp, count) in the time order
+        """
+        return self._query(
+            'SELECT scans.timestamp, COALESCE(scan_items.count, 0) FROM scans '
+            'LEFT JOIN scan_items ON scan_items.scan_id = scans.id AND scan_items.item = ? '
+            'WHERE scans.timestamp BETWEEN ? AND ? ORDER BY scans.timestamp',
+            (item, since, until))
+
+    def drop_rates(self, since: float = 0.0, until: float = float('inf')) -> Dict[str, float]:
+        """
+        Items gained per hour between the scans in the time range. Only the increases between the consecutive scans
+        count, the items used up in the recipes don't lower the rate.
+        """
+        bounds = self._query('SELECT MIN(timestamp), MAX(timestamp) FROM scans WHERE timestamp BETWEEN ? AND ?', (since, until))[0]
+        if bounds[0] is None or bounds[1] <= bounds[0]:
+            return dict()
+        hours = (bounds[1] - bounds[0]) / 3600
+        # Every item of the scan is compared to the same item of the previous scan, the new items to nothing
+        gains = self._query(
+            'WITH ordered AS (SELECT id, LAG(id) OVER (ORDER BY timestamp) AS previous_id FROM scans WHERE timestamp BETWEEN ? AND ?) '
+            'SELECT current.item, SUM(current.count - COALESCE(previous.count, 0)) FROM ordered '
+            'JOIN scan_items AS current ON current.scan_id = ordered.id '
+            'LEFT JOIN scan_items AS previous ON previous.scan_id = ordered.previous_id AND previous.item = current.item '
+            'WHERE ordered.previous_id IS NOT NULL AND current.count > COALESCE(previous.count, 0) '
+            'GROUP BY current.item',
+            (since, until))
+        return {item: gained / hours for item, gained in gains}
@@ -1,13 +1,14 @@
 import sys
+import time
+import ctypes
 from configparser import ConfigParser
 import tkinter as tk
-from typing import Callable, Any, Tuple, List, Dict
-import os
+from typing import Tuple, List, Dict
 import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, Future
 
-import cv2
-import numpy as np
-from PIL import ImageTk, Image, ImageGrab
+from poe_arch_engine import ArchnemesisItemsMap, ImageScanner, ScanCancelled, ScanProgress, DEFAULT_COMBOS, RecipePlanner, Calibrator, CalibrationProfile, InventoryWatcher, ScanLedger, calculate_default_scale, create_capture_backend, tracer
 
 COLOR_BG = 'grey19'
 COLOR_FG_WHITE = 'snow'
@@ -16,206 +17,30 @@ COLOR_FG_ORANGE = 'orange2'
 FONT_BIG = ('Consolas', '14')
 FONT_SMALL = ('Consolas', '9')
 
-class ArchnemesisItemsMap:
-    """
-    Holds the information about all archnemesis items, recipes, images and map them together
-    """
-    def __init__(self, scale: float):
-        # Put everything into the list so we could maintain the display order
-        self._arch_items = [
-            ('Kitava-Touched', ['Tukohama-Touched', 'Abberath-Touched', 'Corrupter', 'Corpse Detonator']),
-            ('Innocence-Touched', ['Lunaris-Touched', 'Solaris-Touched', 'Mirror Image', 'Mana Siphoner']),
-            ('Shakari-Touched', ['Entangler', 'Soul Eater', 'Drought Bringer']),
-            ('Abberath-Touched', ['Flame Strider', 'Frenzied', 'Rejuvenating']),
-            ('Tukohama-Touched', ['Bonebreaker', 'Executioner', 'Magma Barrier']),
-            ('Brine King-Touched', ['Ice Prison', 'Storm Strider', 'Heralding Minions']),
-            ('Arakaali-Touched', ['Corpse Detonator', 'Entangler', 'Assassin']),
-            ('Solaris-Touched', ['Invulnerable', 'Magma Barrier', 'Empowered Minions']),
-            ('Lunaris-Touched', ['Invulnerable', 'Frost Strider', 'Empowered Minions']),
-            ('Effigy', ['Hexer', 'Malediction', 'Corrupter']),
-            ('Empowered Elements', ['Evocationist', 'Steel-Infused', 'Chaosweaver']),
-            ('Crystal-Skinned', ['Permafrost', 'Rejuvenating', 'Berserker']),
-            ('Invulnerable', ['Sentinel', 'Juggernaut', 'Consecrator']),
-            ('Corrupter', ['Bloodletter', 'Chaosweaver']),
-            ('Mana Siphoner', ['Consecrator', 'Dynamo']),
-            ('Storm Strider', ['Stormweaver', 'Hasted']),
-            ('Mirror Image', ['Echoist', 'Soul Conduit']),
-            ('Magma Barrier', ['Incendiary', 'Bonebreaker']),
-            ('Evocationist', ['Flameweaver', 'Frostweaver', 'Stormweaver']),
-            ('Corpse Detonator', ['Necromancer', 'Incendiary']),
-            ('Flame Strider', ['Flameweaver', 'Hasted']),
-            ('Soul Eater', ['Soul Conduit', 'Necromancer', 'Gargantuan']),
-            ('Ice Prison', ['Permafrost', 'Sentinel']),
-            ('Frost Strider', ['Frostweaver', 'Hasted']),
-            ('Treant Horde', ['Toxic', 'Sentinel', 'Steel-Infused']),
-            ('Temporal Bubble', ['Juggernaut', 'Hexer', 'Arcane Buffer']),
-            ('Entangler', ['Toxic', 'Bloodletter']),
-            ('Drought Bringer', ['Malediction', 'Deadeye']),
-            ('Hexer', ['Chaosweaver', 'Echoist']),
-            ('Executioner', ['Frenzied', 'Berserker']),
-            ('Rejuvenating', ['Gargantuan', 'Vampiric']),
-            ('Necromancer', ['Bombardier', 'Overcharged']),
-            ('Trickster', ['Overcharged', 'Assassin', 'Echoist']),
-            ('Assassin', ['Deadeye', 'Vampiric']),
-            ('Empowered Minions', ['Necromancer', 'Executioner', 'Gargantuan']),
-            ('Heralding Minions', ['Dynamo', 'Arcane Buffer']),
-            ('Arcane Buffer', []),
-            ('Berserker', []),
-            ('Bloodletter', []),
-            ('Bombardier', []),
-            ('Bonebreaker', []),
-            ('Chaosweaver', []),
-            ('Consecrator', []),
-            ('Deadeye', []),
-            ('Dynamo', []),
-            ('Echoist', []),
-            ('Flameweaver', []),
-            ('Frenzied', []),
-            ('Frostweaver', []),
-            ('Gargantuan', []),
-            ('Hasted', []),
-            ('Incendiary', []),
-            ('Juggernaut', []),
-            ('Malediction', []),
-            ('Opulent', []),
-            ('Overcharged', []),
-            ('Permafrost', []),
-            ('Sentinel', []),
-            ('Soul Conduit', []),
-            ('Steel-Infused', []),
-            ('Stormweaver', []),
-            ('Toxic', []),
-            ('Vampiric', []),
-            ('Combo', []),
-        ]
-        self._images = dict()
-        self._update_images(scale)
-
-    def _update_images(self, scale):
-        self._scale = scale
-        for item, _ in self._arch_items:
-            self._images[item] = dict()
-            image = self._load_image(item, scale)
-            self._image_size = image.size
-            self._images[item]['scan-image'] = self._create_scan_image(image)
-            # Convert the image to Tk image because we're going to display it
-            self._images[item]['display-image'] = ImageTk.PhotoImage(image=image)
-            image = image.resize((30, 30))
-            self._images[item]['display-small-image'] = ImageTk.PhotoImage(image=image)
-
-    def _load_image(self, item: str, scale: float):
-        image = Image.open(f'pictures/{item}.png')
-        # Scale the image according to the input parameter
-        return image.resize((int(image.width * scale), int(image.height * scale)))
-
-    def _create_scan_image(self, image):
-        # Remove alpha channel and replace it with predefined background color
-        background = Image.new('RGBA', image.size, (10, 10, 32))
-        image_without_alpha = Image.alpha_composite(background, image)
-        scan_template = cv2.cvtColor(np.array(image_without_alpha), cv2.COLOR_RGB2BGR)
-        w, h, _ = scan_template.shape
-
-        # Crop the image to help with scanning
-        return scan_template[int(h * 1.0 / 10):int(h * 2.3 / 3), int(w * 1.0 / 6):int(w * 5.5 / 6)]
-
-
-    def get_scan_image(self, item):
-        return self._images[item]['scan-image']
-
-    def get_display_image(self, item):
-        return self._images[item]['display-image']
-
-    def get_display_small_image(self, item):
-        return self._images[item]['display-small-image']
-
-    def items(self):
-        for item, _ in self._arch_items:
-            yield item
-
-    def recipes(self):
-        for item, recipe in self._arch_items:
-            if recipe:
-                yield (item, recipe)
-
-    @property
-    def image_size(self):
-        return self._image_size
-
-    @property
-    def scale(self) -> float:
-        return self._scale
-
-    @scale.setter
-    def scale(self, scale: float) -> None:
-        self._update_images(scale)
-
-
-class ImageScanner:
-    """
-    Implements scanning algorithm with OpenCV. Maintans the scanning window to speed up the scanning.
-    """
-    def __init__(self, screen_width: int, screen_height: int, items_map: ArchnemesisItemsMap):
-        self._screen_width = screen_width
-        self._screen_height = screen_height
-        self._scanner_window_size = tuple(map(int, [0.1 * screen_height, 0.3 * screen_height, 0.41 * screen_height, 0.41 * screen_height]))
-        self._items_map = items_map
-        self._confidence_threshold = 0.94
-
-    def scan(self) -> Dict[str, List[Tuple[int, int]]]:
-        bbox = (self._scanner_window_size[0], self._scanner_window_size[1], self._scanner_window_size[0] + self._scanner_window_size[2], self._scanner_window_size[1] + self._scanner_window_size[3])
-        print('bbox=', bbox)
-        screen = ImageGrab.grab(bbox=bbox)
-        screen = np.array(screen)
-        screen = cv2.cvtColor(screen, cv2.COLOR_RGB2BGR)
-
-        results = dict()
-
-        for item in self._items_map.items():
-            heat_map = cv2.matchTemplate(screen, self._items_map.get_scan_image(item), cv2.TM_CCOEFF_NORMED)
-            _, confidence, _, (x, y) = cv2.minMaxLoc(heat_map)
-            print(f'Best match for {item}: x={x}, y={y} = {confidence}')
-            findings = np.where(heat_map >= self._confidence_threshold)
-            if len(findings[0]) > 0:
-                results[item] = [(findings[1][i], findings[0][i]) for i in range(len(findings[0]))]
-        return results
-
-    @property
-    def scanner_window_size(self) -> Tuple[int, int, int, int]:
-        return self._scanner_window_size
-
-    @scanner_window_size.setter
-    def scanner_window_size(self, value: Tuple[int, int, int, int]) -> None:
-        self._scanner_window_size = value
-
-    @property
-    def confidence_threshold(self) -> float:
-        return self._confidence_threshold
-
-    @confidence_threshold.setter
-    def confidence_threshold(self, value) -> None:
-        self._confidence_threshold = value
-
-    @property
-    def screen_width(self) -> int:
-        return self._screen_width
-
-    @property
-    def screen_height(self) -> int:
-        return self._screen_height
-
-
 class UIOverlay:
     """
     Overlay window using tkinter '-topmost' property
     """
+    # How often (in ms) the running scan is checked, so the UI stays responsive at 60 Hz
+    SCAN_POLL_INTERVAL = 16
+
     def __init__(self, root, items_map: ArchnemesisItemsMap, image_scanner: ImageScanner):
         self._items_map = items_map
         self._image_scanner = image_scanner
         self._root = root
         self._scan_results_window = None
-        self._highlight_windows_to_show = list()
-
-        self._settings = Settings(root, items_map, image_scanner)
+        # Highlight windows are reused between the hovers, they are only moved and shown or hidden
+        self._highlight_windows = list()
+        self._visible_highlights = 0
+        # Rows of the scan results panel by their item (and the recipe status)
+        self._result_rows = dict()
+        # Scans run on their own thread, so the Tk main loop is never blocked
+        self._scan_executor = ThreadPoolExecutor(max_workers=1)
+        self._scan_progress = None
+        self._planner = RecipePlanner(items_map)
+        self._watcher = InventoryWatcher()
+
+        self._settings = Settings(root, items_map, image_scanner, self._watcher)
         self._create_controls()
 
         self._root.configure(bg='')
@@ -227,6 +52,7 @@ class UIOverlay:
 
         self._results = {}
         self._available_recipes = []
+        self._root.after(self._watcher.poll_interval, self._watch)
 
     @staticmethod
     def create_toplevel_window(bg=''):
@@ -240,7 +66,7 @@ class UIOverlay:
 
     def _create_controls(self) -> None:
         l = tk.Button(self._root, text='[X]', fg=COLOR_FG_GREEN, bg=COLOR_BG, font=FONT_SMALL)
-        l.bind('<Button-1>', sys.exit)
+        l.bind('<Button-1>', self._exit)
         l.grid(row=0, column=0)
 
         settings = tk.Button(self._root, text='Settings', fg=COLOR_FG_GREEN, bg=COLOR_BG, font=FONT_SMALL)
@@ -257,67 +83,64 @@ class UIOverlay:
         self._toggle_label.bind("<Button-1>", self._toggle)
         self._toggle_label.grid(row=0, column=3)
     
-    def _eval(self, combo, inventory):
-        recipes = {}
-        for result, ingredient in self._items_map.recipes():
-            recipes[result] = ingredient
-        viable = []
-        short = []
-        reserved = {}
-
-        def search(item):
-            if inventory.get(item):
-                loc, inventory[item] = inventory[item][0], inventory[item][1:]
-                if len(inventory[item]) == 0:
-                    del inventory[item]
-                return loc
-            elif reserved.get(item):
-                loc, reserved[item] = reserved[item][0], reserved[item][1:]
-                if len(reserved[item]) == 0:
-                    del reserved[item]
-                return loc
-            elif len(recipes.get(item, [])) > 0:
-                locs = [search(x) for x in recipes[item]]
-                if all(loc is not None for loc in locs):
-                    viable.append((item, [x for x in locs if len(x) > 0], False))
-                    return None
-                else:
-                    for name, loc in zip(recipes[item], locs):
-                        if loc is not None:
-                            reserved.setdefault(name, [])
-                            reserved[name].append(loc)
-                        else:
-                            short.append(name)
-            return None
-
-        if all(inventory.get(i) for i in combo):
-            viable.append(('Combo', [inventory[i][0] for i in combo], False))
-            for item in combo:
-                inventory[item] = inventory[item][1:]
-                if len(inventory[item]) == 0:
-                    del inventory[item]
-        else:
-            for item in combo:
-                search(item)
-        print('Short:', short)
-        return viable
-
-    def _scan(self, _) -> None:
+    def _exit(self, _) -> None:
+        # The scan and calibration threads aren't daemons, so Python waits for them at exit. Stop them first.
+        if self._scan_progress is not None:
+            self._scan_progress.cancel()
+        self._scan_executor.shutdown(wait=False, cancel_futures=True)
+        self._settings.shutdown()
+        sys.exit()
+
+    def _scan(self, _, screen=None) -> None:
+        # A new scan supersedes the running one
+        if self._scan_progress is not None:
+            self._scan_progress.cancel()
+        progress = ScanProgress()
+        self._scan_progress = progress
         self._scan_label_text.set('Scanning...')
-        self._root.update()
-        results = self._image_scanner.scan()
-        print('Count:', sum(map(lambda x: len(x), results.values())))
-        item_list = []
-        for name, locs in results.items():
-            item_list.extend((loc, name) for loc in locs)
-        for loc, name in sorted(item_list):
-            print(loc, name)
+        combos = [list(combo) for combo in self._settings.combos()]
+        future = self._scan_executor.submit(self._run_scan, progress, combos, screen)
+        self._root.after(UIOverlay.SCAN_POLL_INTERVAL, self._poll_scan, progress, future)
+
+    def _run_scan(self, progress: ScanProgress, combos: List[List[str]], screen=None):
+        """
+        Runs on the scan thread, so it must not touch any Tk objects. The watch mode passes the screen it has already
+        captured.
+        """
+        if screen is None:
+            screen = self._image_scanner.capture()
+        results = self._image_scanner.scan_image(screen, progress)
+        fingerprint = InventoryWatcher.fingerprint(screen)
+        available_recipes = []
         if len(results) > 0:
-            for item in sorted(results.keys()):
-                print(item, results[item])
-            available_recipes = []
-            for combo in self._settings.combos():
-                available_recipes.extend(self._eval(combo, results))
+            progress.check()
+            with tracer.span('plan', combos=len(combos)) as span:
+                plan = self._planner.plan(results, combos)
+                span.set(completed_combos=plan.completed_combos, shortfall=plan.shortfall)
+            available_recipes = plan.recipes
+        return (results, available_recipes, fingerprint)
+
+    def _poll_scan(self, progress: ScanProgress, future: Future) -> None:
+        if progress is not self._scan_progress:
+            # The scan was superseded by a newer one, its results will be dropped
+            return
+        if not future.done():
+            self._scan_label_text.set(f'Scanning... {int(progress.fraction * 100)}%')
+            self._root.after(UIOverlay.SCAN_POLL_INTERVAL, self._poll_scan, progress, future)
+            return
+        self._scan_progress = None
+        self._scan_label_text.set('Scan')
+        try:
+            results, available_recipes, fingerprint = future.result()
+        except ScanCancelled:
+            return
+        self._watcher.scanned(fingerprint, results, self._image_scanner.template_size(), self._image_scanner.scanner_window_size[2:])
+        if len(results) > 0:
+            if self._settings.ledger is not None:
+                # The ledger keeps the screen coordinates, the same as the scan service records
+                x, y = self._image_scanner.scanner_window_size[:2]
+                to_screen = lambda locations: [(x + location_x, y + location_y) for location_x, location_y in locations]
+                self._settings.ledger.record({item: to_screen(locations) for item, locations in results.items()}, [(item, to_screen(locations), exists) for item, locations, exists in available_recipes])
             self._results = results
             self._available_recipes = available_recipes
             if len(self._available_recipes) == 0:
@@ -328,8 +151,38 @@ class UIOverlay:
             self._results = {}
             self._available_recipes = []
             self._hide(None)
-        self._scan_label_text.set('Scan')
-    
+
+    def _watch(self) -> None:
+        if not self._watcher.enabled or self._scan_progress is not None:
+            # The running scan updates the watcher when it's done
+            self._root.after(self._watcher.poll_interval, self._watch)
+            return
+        future = self._scan_executor.submit(self._run_watch)
+        self._root.after(UIOverlay.SCAN_POLL_INTERVAL, self._poll_watch, future)
+
+    def _run_watch(self):
+        """
+        Runs on the scan thread. Returns the captured scanner window if it should be scanned, otherwise None.
+        """
+        with tracer.span('watch'):
+            screen = self._image_scanner.capture()
+            return screen if self._watcher.update(InventoryWatcher.fingerprint(screen)) else None
+
+    def _poll_watch(self, future: Future) -> None:
+        if not future.done():
+            self._root.after(UIOverlay.SCAN_POLL_INTERVAL, self._poll_watch, future)
+            return
+        try:
+            screen = future.result()
+            # A scan started by hand in the meantime wins
+            if screen is not None and self._scan_progress is None:
+                self._scan(None, screen)
+        except Exception as e:
+            print(f'Watch mode poll failed: {e!r}')
+        finally:
+            # The watch mode keeps going whatever happened to this poll
+            self._root.after(self._watcher.poll_interval, self._watch)
+
     def _toggle(self, _) -> None:
         if not self._recipes_visible:
             if len(self._available_recipes) == 0:
@@ -357,85 +210,181 @@ class UIOverlay:
 
     def _hide(self, _) -> None:
         if self._scan_results_window is not None:
-            self._scan_results_window.destroy()
+            self._scan_results_window.withdraw()
         self._clear_highlights(None)
 
     def _show_scan_results(self, results: Dict[str, List[Tuple[int, int]]], available_recipes: List[Tuple[str, List[Tuple[int, int]], bool]], result_visible: bool) -> None:
-        self._hide(None)
+        with tracer.span('show scan results'):
+            self._create_scan_results(results, available_recipes, result_visible)
+
+    def _create_scan_results(self, results: Dict[str, List[Tuple[int, int]]], available_recipes: List[Tuple[str, List[Tuple[int, int]], bool]], result_visible: bool) -> None:
+        self._clear_highlights(None)
         self._recipes_visible = True
         self._results = results
         self._available_recipes = available_recipes
-        self._scan_results_window = UIOverlay.create_toplevel_window()
-        x = int(self._root.winfo_x())
-        y = int(self._root.winfo_y() + self._root.winfo_height())
-        self._scan_results_window.geometry(f'+{x}+{y}')
+        # The panel is built once and its rows are updated in place
+        if self._scan_results_window is None:
+            self._scan_results_window = UIOverlay.create_toplevel_window()
 
+        entries = []
         last_column = 0
         if result_visible:
-            last_column = self._show_inventory_list(results)
-        self._show_available_recipes_list(available_recipes, last_column + 2)
+            last_column = self._show_inventory_list(results, entries)
+        self._show_available_recipes_list(available_recipes, last_column + 2, entries)
+        self._update_result_rows(entries)
+
+        x = int(self._root.winfo_x())
+        y = int(self._root.winfo_y() + self._root.winfo_height())
+        self._scan_results_window.geometry(f'+{x}+{y}')
+        self._scan_results_window.deiconify()
 
-    def _show_inventory_list(self, results: Dict[str, List[Tuple[int, int]]]) -> int:
+    def _show_inventory_list(self, results: Dict[str, List[Tuple[int, int]]], entries: list) -> int:
         row = 0
         column = 0
 
         for item in self._items_map.items():
             inventory_items = results.get(item)
             if inventory_items is not None:
-                row, column = self._show_image_and_label(item, inventory_items, COLOR_FG_WHITE, f'x{len(inventory_items)} {item}', row, column)
+                row, column = self._show_image_and_label(entries, ('inventory', item), item, inventory_items, COLOR_FG_WHITE, f'x{len(inventory_items)} {item}', row, column)
         return column
 
 
-    def _show_available_recipes_list(self, available_recipes: List[Tuple[str, List[Tuple[int, int]], bool]], column: int) -> None:
+    def _show_available_recipes_list(self, available_recipes: List[Tuple[str, List[Tuple[int, int]], bool]], column: int, entries: list) -> None:
         row = 0
+        occurrences = dict()
 
         for item, inventory_items, exists_in_inventory in available_recipes:
             if exists_in_inventory:
                 fg = COLOR_FG_GREEN
             else:
                 fg = COLOR_FG_ORANGE
-            row, column = self._show_image_and_label(item, inventory_items, fg, item, row, column)
+            # The same item could be crafted more than once
+            occurrences[item] = occurrences.get(item, 0) + 1
+            row, column = self._show_image_and_label(entries, ('recipe', item, occurrences[item]), item, inventory_items, fg, item, row, column)
 
-    def _show_image_and_label(self, item, inventory_items: Tuple[int, int], highlight_color: str, label_text: str, row: int, column: int) -> Tuple[int, int]:
-        image = tk.Label(self._scan_results_window, image=self._items_map.get_display_small_image(item), bg=COLOR_BG, pady=5)
-        image.bind('<Enter>', lambda _, arg=inventory_items, color=highlight_color: self._highlight_items_in_inventory(arg, color))
-        image.bind('<Leave>', self._clear_highlights)
-        image.grid(row=row, column=column)
-        tk.Label(self._scan_results_window, text=label_text, font=FONT_BIG, fg=highlight_color, bg=COLOR_BG).grid(row=row, column=column + 1, sticky='w', padx=5)
+    def _show_image_and_label(self, entries: list, key: Tuple, item, inventory_items: List[Tuple[int, int]], highlight_color: str, label_text: str, row: int, column: int) -> Tuple[int, int]:
+        entries.append((key, item, inventory_items, highlight_color, label_text, (row, column)))
         row += 1
         if row % 8 == 0:
             column += 2
             row = 0
         return (row, column)
 
+    def _update_result_rows(self, entries: list) -> None:
+        """
+        Create, reconfigure or remove only the rows of the panel which differ from the entries
+        """
+        created = updated = 0
+        keys = set()
+        for key, item, inventory_items, highlight_color, label_text, position in entries:
+            keys.add(key)
+            result_row = self._result_rows.get(key)
+            if result_row is None:
+                result_row = self._create_result_row()
+                self._result_rows[key] = result_row
+                created += 1
+            elif result_row.differs(label_text, highlight_color, position):
+                updated += 1
+            result_row.update(self._items_map.get_display_small_image(item), label_text, highlight_color, inventory_items, position)
+        removed = [key for key in self._result_rows if key not in keys]
+        for key in removed:
+            self._result_rows.pop(key).destroy()
+        tracer.count('result rows', {'created': created, 'updated': updated, 'removed': len(removed)})
+
+    def _create_result_row(self) -> 'ResultRow':
+        image = tk.Label(self._scan_results_window, bg=COLOR_BG, pady=5)
+        label = tk.Label(self._scan_results_window, font=FONT_BIG, bg=COLOR_BG)
+        result_row = ResultRow(image, label)
+        # The handler reads the row's current locations, so the binding survives the updates
+        image.bind('<Enter>', lambda _: self._highlight_items_in_inventory(result_row.locations, result_row.color))
+        image.bind('<Leave>', self._clear_highlights)
+        return result_row
+
     def _highlight_items_in_inventory(self, inventory_items: List[Tuple[int, int]], color: str) -> None:
-        self._highlight_windows_to_show = list()
-        for (x, y) in inventory_items:
+        with tracer.span('highlight', items=len(inventory_items)):
             x_offset, y_offset, _, _ = self._image_scanner.scanner_window_size
-            x += x_offset
-            y += y_offset
             width = int(self._items_map.image_size[0] * 0.7)
             height = int(self._items_map.image_size[1] * 0.7)
-            w = UIOverlay.create_toplevel_window(bg=color)
-            w.geometry(f'{width}x{height}+{x}+{y}')
-            self._highlight_windows_to_show.append(w)
+            while len(self._highlight_windows) < len(inventory_items):
+                w = UIOverlay.create_toplevel_window()
+                w.withdraw()
+                self._highlight_windows.append(w)
+            for w, (x, y) in zip(self._highlight_windows, inventory_items):
+                w.configure(bg=color)
+                w.geometry(f'{width}x{height}+{x + x_offset}+{y + y_offset}')
+                w.deiconify()
+            # Hide the windows left from the previous hover with more items
+            for w in self._highlight_windows[len(inventory_items):self._visible_highlights]:
+                w.withdraw()
+            self._visible_highlights = len(inventory_items)
 
     def _clear_highlights(self, _) -> None:
-        for w in self._highlight_windows_to_show:
-            w.destroy()
+        for w in self._highlight_windows[:self._visible_highlights]:
+            w.withdraw()
+        self._visible_highlights = 0
 
     def run(self) -> None:
         self._root.mainloop()
 
 
+class ResultRow:
+    """
+    Image and label of one item in the scan results panel. Only the parts which changed get reconfigured.
+    """
+    __slots__ = ('image', 'label', 'photo', 'text', 'color', 'locations', 'position')
+
+    def __init__(self, image: tk.Label, label: tk.Label):
+        self.image = image
+        self.label = label
+        self.photo = None
+        self.text = None
+        self.color = None
+        self.locations = []
+        self.position = None
+
+    def differs(self, text: str, color: str, position: Tuple[int, int]) -> bool:
+        return text != self.text or color != self.color or position != self.position
+
+    def update(self, photo, text: str, color: str, locations: List[Tuple[int, int]], position: Tuple[int, int]) -> None:
+        # The display images are created again when the image scale changes
+        if photo is not self.photo:
+            self.image.configure(image=photo)
+            self.photo = photo
+        if text != self.text or color != self.color:
+            self.label.configure(text=text, fg=color)
+            self.text = text
+            self.color = color
+        if position != self.position:
+            row, column = position
+            self.image.grid(row=row, column=column)
+            self.label.grid(row=row, column=column + 1, sticky='w', padx=5)
+            self.position = position
+        self.locations = locations
+
+    def destroy(self) -> None:
+        self.image.destroy()
+        self.label.destroy()
+
+
 class Settings:
-    def __init__(self, root, items_map, image_scanner):
+    # How often (in ms) the running calibration is checked
+    CALIBRATION_POLL_INTERVAL = 100
+
+    def __init__(self, root, items_map, image_scanner, watcher):
         self._root = root
         self._items_map = items_map
         self._image_scanner = image_scanner
+        self._watcher = watcher
+        self._calibration_executor = ThreadPoolExecutor(max_workers=1)
+        self._calibration_text = tk.StringVar(root, value='Calibrate')
+        self._calibrating = False
+        self._calibration_progress = None
 
         self._config = ConfigParser()
         self._config_file = 'settings.ini'
+        self._trace_file = 'scan_trace.json'
+        self._ledger_file = 'scan_ledger.db'
+        self.ledger = None
 
         self._config.read(self._config_file)
         if 'settings' not in self._config:
@@ -449,16 +398,37 @@ class Settings:
         self._image_scanner.confidence_threshold = float(s.get('confidence_threshold', self._image_scanner.confidence_threshold))
         b = s.get('display_inventory_items')
         self._display_inventory_items = True if b is not None and b == 'True' else False
+        self._image_scanner.grid_mode = s.get('grid_mode') == 'True'
+        tracer.enabled = s.get('trace') == 'True'
+        self._image_scanner.workers = int(s.get('scan_workers', self._image_scanner.workers))
+        self._image_scanner.pyramid_factor = float(s.get('pyramid_factor', self._image_scanner.pyramid_factor))
+        self._image_scanner.working_size = int(s.get('working_size', self._image_scanner.working_size))
+        self._image_scanner.cascade = s.get('cascade') == 'True'
+        self._image_scanner.scale_bank = int(s.get('scale_bank', self._image_scanner.scale_bank))
+        self._watcher.enabled = s.get('watch_mode') == 'True'
+        self._watcher.interval = int(s.get('watch_interval', self._watcher.interval))
+        if s.get('scan_ledger') == 'True':
+            self._open_ledger()
+        self._capture_backend = s.get('capture_backend', 'imagegrab')
+        try:
+            self._image_scanner.capture_backend = create_capture_backend(self._capture_backend)
+        except ValueError as e:
+            print(f'Unable to use the capture backend: {e}')
+            self._capture_backend = 'imagegrab'
         if s.get('combos') is None:
-            self._combos = [
-            ['Innocence-Touched', 'Brine King-Touched', 'Kitava-Touched', 'Treant Horde'],
-            ['Mirror Image', 'Assassin', 'Rejuvenating', 'Treant Horde'],
-            ['Innocence-Touched', 'Brine King-Touched', 'Kitava-Touched', 'Treant Horde'],
-            ['Arakaali-Touched', 'Brine King-Touched', 'Effigy', 'Treant Horde']
-        ]
+            self._combos = [list(combo) for combo in DEFAULT_COMBOS]
         else:
             self._combos = json.loads(s.get('combos'))
 
+        # Calibration is kept per resolution and overrides the scanner window and image scale
+        self._calibration_section = f'calibration.{self._image_scanner.screen_width}x{self._image_scanner.screen_height}'
+        if self._calibration_section in self._config:
+            try:
+                self._apply_calibration(CalibrationProfile.from_dict(self._config[self._calibration_section]))
+            except (KeyError, ValueError) as e:
+                print(f'Unable to load the calibration profile: {e}')
+                self._config.remove_section(self._calibration_section)
+
     def show(self) -> None:
         self._window = tk.Toplevel()
 
@@ -471,7 +441,7 @@ class Settings:
         self._scanner_window_entry.grid(row=0, column=0)
         tk.Button(self._window, text='Set scanner window', command=self._update_scanner_window).grid(row=0, column=1)
 
-        v = tk.DoubleVar(self._window, value=self._items_map.scale)
+        v = tk.DoubleVar(self._window, value=self._image_scanner.configured_scale)
         self._scale_entry = tk.Entry(self._window, textvariable=v)
         self._scale_entry.grid(row=1, column=0)
         tk.Button(self._window, text='Set image scale', command=self._update_scale).grid(row=1, column=1)
@@ -481,20 +451,89 @@ class Settings:
         self._confidence_threshold_entry.grid(row=2, column=0)
         tk.Button(self._window, text='Set confidence threshold', command=self._update_confidence_threshold).grid(row=2, column=1)
 
+        v = tk.IntVar(self._window, value=self._image_scanner.workers)
+        self._workers_entry = tk.Entry(self._window, textvariable=v)
+        self._workers_entry.grid(row=3, column=0)
+        tk.Button(self._window, text='Set scan workers', command=self._update_workers).grid(row=3, column=1)
+
+        v = tk.DoubleVar(self._window, value=self._image_scanner.pyramid_factor)
+        self._pyramid_factor_entry = tk.Entry(self._window, textvariable=v)
+        self._pyramid_factor_entry.grid(row=4, column=0)
+        tk.Button(self._window, text='Set pyramid factor', command=self._update_pyramid_factor).grid(row=4, column=1)
+
         c = tk.Checkbutton(self._window, text='Display inventory items', command=self._update_display_inventory_items)
-        c.grid(row=3, column=0)
+        c.grid(row=5, column=0)
         if self._display_inventory_items:
             c.select()
 
+        c = tk.Checkbutton(self._window, text='Grid scan mode', command=self._update_grid_mode)
+        c.grid(row=6, column=0)
+        if self._image_scanner.grid_mode:
+            c.select()
+
+        c = tk.Checkbutton(self._window, text='Record scan trace', command=self._update_trace)
+        c.grid(row=7, column=0)
+        if tracer.enabled:
+            c.select()
+        tk.Button(self._window, text='Save scan trace', command=self._save_trace).grid(row=7, column=1)
+
+        tk.Button(self._window, textvariable=self._calibration_text, command=self._calibrate).grid(row=8, column=1)
+
+        v = tk.StringVar(self._window, value=self._capture_backend)
+        self._capture_backend_entry = tk.Entry(self._window, textvariable=v)
+        self._capture_backend_entry.grid(row=9, column=0)
+        tk.Button(self._window, text='Set capture backend', command=self._update_capture_backend).grid(row=9, column=1)
+
+        v = tk.IntVar(self._window, value=self._image_scanner.working_size)
+        self._working_size_entry = tk.Entry(self._window, textvariable=v)
+        self._working_size_entry.grid(row=10, column=0)
+        tk.Button(self._window, text='Set working size', command=self._update_working_size).grid(row=10, column=1)
+
+        c = tk.Checkbutton(self._window, text='Cascade search', command=self._update_cascade)
+        c.grid(row=11, column=0)
+        if self._image_scanner.cascade:
+            c.select()
+
+        c = tk.Checkbutton(self._window, text='Watch mode', command=self._update_watch_mode)
+        c.grid(row=12, column=0)
+        if self._watcher.enabled:
+            c.select()
+
+        v = tk.IntVar(self._window, value=self._watcher.interval)
+        self._watch_interval_entry = tk.Entry(self._window, textvariable=v)
+        self._watch_interval_entry.grid(row=13, column=0)
+        tk.Button(self._window, text='Set watch interval', command=self._update_watch_interval).grid(row=13, column=1)
+
+        c = tk.Checkbutton(self._window, text='Record scan ledger', command=self._update_scan_ledger)
+        c.grid(row=14, column=0)
+        if self.ledger is not None:
+            c.select()
+
+        v = tk.IntVar(self._window, value=self._image_scanner.scale_bank)
+        self._scale_bank_entry = tk.Entry(self._window, textvariable=v)
+        self._scale_bank_entry.grid(row=15, column=0)
+        tk.Button(self._window, text='Set scale bank', command=self._update_scale_bank).grid(row=15, column=1)
+
     def _close(self) -> None:
         self._window.destroy()
 
     def _save_config(self) -> None:
         self._config['settings']['scanner_window'] = str(self._image_scanner.scanner_window_size)
-        self._config['settings']['image_scale'] = str(self._items_map.scale)
+        self._config['settings']['image_scale'] = str(self._image_scanner.configured_scale)
         self._config['settings']['confidence_threshold'] = str(self._image_scanner.confidence_threshold)
         self._config['settings']['combos'] = json.dumps(self._combos)
         self._config['settings']['display_inventory_items'] = str(self._display_inventory_items)
+        self._config['settings']['grid_mode'] = str(self._image_scanner.grid_mode)
+        self._config['settings']['trace'] = str(tracer.enabled)
+        self._config['settings']['scan_workers'] = str(self._image_scanner.workers)
+        self._config['settings']['pyramid_factor'] = str(self._image_scanner.pyramid_factor)
+        self._config['settings']['capture_backend'] = self._capture_backend
+        self._config['settings']['working_size'] = str(self._image_scanner.working_size)
+        self._config['settings']['cascade'] = str(self._image_scanner.cascade)
+        self._config['settings']['watch_mode'] = str(self._watcher.enabled)
+        self._config['settings']['watch_interval'] = str(self._watcher.interval)
+        self._config['settings']['scan_ledger'] = str(self.ledger is not None)
+        self._config['settings']['scale_bank'] = str(self._image_scanner.scale_bank)
         with open(self._config_file, 'w') as f:
             self._config.write(f)
 
@@ -509,6 +548,8 @@ class Settings:
         scanner_window_to_show.geometry(f'{width}x{height}+{x}+{y}')
         self._image_scanner.scanner_window_size = (x, y, width, height)
         scanner_window_to_show.after(200, scanner_window_to_show.destroy)
+        self._watcher.reset()
+        self._clear_calibration()
         self._save_config()
 
     def _update_scale(self) -> None:
@@ -518,6 +559,7 @@ class Settings:
             print('Unable to parse image scale parameter')
             return
         self._items_map.scale = new_scale
+        self._clear_calibration()
         self._save_config()
 
     def _update_confidence_threshold(self) -> None:
@@ -529,79 +571,209 @@ class Settings:
         self._image_scanner.confidence_threshold = new_threshold
         self._save_config()
 
+    def _update_workers(self) -> None:
+        try:
+            new_workers = int(self._workers_entry.get())
+        except ValueError:
+            print('Unable to parse scan workers parameter')
+            return
+        if new_workers < 1:
+            print('Scan workers parameter should be positive')
+            return
+        self._image_scanner.workers = new_workers
+        self._save_config()
+
+    def _update_pyramid_factor(self) -> None:
+        try:
+            new_factor = float(self._pyramid_factor_entry.get())
+        except ValueError:
+            print('Unable to parse pyramid factor parameter')
+            return
+        self._image_scanner.pyramid_factor = new_factor
+        self._save_config()
+
+    def _update_working_size(self) -> None:
+        try:
+            new_size = int(self._working_size_entry.get())
+        except ValueError:
+            print('Unable to parse working size parameter')
+            return
+        if new_size < 0:
+            print('Working size parameter should not be negative')
+            return
+        self._image_scanner.working_size = new_size
+        self._save_config()
+
+    def _update_scale_bank(self) -> None:
+        try:
+            new_radius = int(self._scale_bank_entry.get())
+        except ValueError:
+            print('Unable to parse scale bank parameter')
+            return
+        if new_radius < 0:
+            print('Scale bank parameter should not be negative')
+            return
+        self._image_scanner.scale_bank = new_radius
+        self._save_config()
+
+    def _update_capture_backend(self) -> None:
+        name = self._capture_backend_entry.get().strip()
+        try:
+            self._image_scanner.capture_backend = create_capture_backend(name)
+        except ValueError as e:
+            print(f'Unable to use the capture backend: {e}')
+            return
+        self._capture_backend = name
+        self._save_config()
+
     def _update_display_inventory_items(self) -> None:
         self._display_inventory_items = not self._display_inventory_items
         self._save_config()
 
-    def should_display_inventory_items(self) -> bool:
-        return self._display_inventory_items
+    def _update_trace(self) -> None:
+        tracer.enabled = not tracer.enabled
+        self._save_config()
 
-    def combos(self):
-        return self._combos
+    def _save_trace(self) -> None:
+        try:
+            tracer.dump(self._trace_file)
+        except OSError as e:
+            print(f'Unable to save the scan trace: {e}')
+            return
+        print(f'Scan trace saved to {self._trace_file}')
 
-def calculate_default_scale(screen_width: int, screen_height: int) -> float:
-    """
-    TODO: validate the math for non 16:9 resolutions (e.g. ultrawide monitors)
-    """
+    def _update_cascade(self) -> None:
+        self._image_scanner.cascade = not self._image_scanner.cascade
+        self._save_config()
+
+    def _update_watch_mode(self) -> None:
+        self._watcher.enabled = not self._watcher.enabled
+        self._save_config()
+
+    def _update_watch_interval(self) -> None:
+        try:
+            new_interval = int(self._watch_interval_entry.get())
+        except ValueError:
+            print('Unable to parse watch interval parameter')
+            return
+        if new_interval < 1:
+            print('Watch interval parameter should be positive')
+            return
+        self._watcher.interval = new_interval
+        self._save_config()
+
+    def _update_scan_ledger(self) -> None:
+        if self.ledger is None:
+            self._open_ledger()
+        else:
+            self.ledger.close()
+            self.ledger = None
+        self._save_config()
+
+    def _open_ledger(self) -> None:
+        try:
+            self.ledger = ScanLedger(self._ledger_file)
+        except sqlite3.Error as e:
+            print(f'Unable to open the scan ledger: {e}')
 
-    # Assume that all source images have 78x78 size
-    source_image_height = 78.0
+    def _update_grid_mode(self) -> None:
+        self._image_scanner.grid_mode = not self._image_scanner.grid_mode
+        self._save_config()
 
-    # Take 0.90 as a golden standard for 2560x1440 resolution and calculate
-    # scales for other resolutions based on that
-    constant = 1440.0 / (source_image_height * 0.91)
-    scale = screen_height / (source_image_height * constant)
+    def _calibrate(self) -> None:
+        if self._calibrating:
+            return
+        self._calibrating = True
+        self._calibration_text.set('Calibrating...')
+        progress = ScanProgress()
+        self._calibration_progress = progress
+        future = self._calibration_executor.submit(self._run_calibration, progress)
+        self._root.after(Settings.CALIBRATION_POLL_INTERVAL, self._poll_calibration, progress, future)
+
+    def _run_calibration(self, progress: ScanProgress):
+        """
+        Runs on the calibration thread, so it must not touch any Tk objects
+        """
+        screen = self._image_scanner.capture()
+        calibrator = Calibrator(self._image_scanner.screen_width, self._image_scanner.screen_height, self._items_map, self._image_scanner.confidence_threshold)
+        default_scale = calculate_default_scale(self._image_scanner.screen_width, self._image_scanner.screen_height)
+        with tracer.span('calibrate'):
+            return calibrator.calibrate(screen, self._image_scanner.scanner_window_size, default_scale, progress)
+
+    def _poll_calibration(self, progress: ScanProgress, future: Future) -> None:
+        if not future.done():
+            self._calibration_text.set(f'Calibrating... {int(progress.fraction * 100)}%')
+            self._root.after(Settings.CALIBRATION_POLL_INTERVAL, self._poll_calibration, progress, future)
+            return
+        self._calibrating = False
+        self._calibration_progress = None
+        self._calibration_text.set('Calibrate')
+        profile = future.result()
+        if profile is None:
+            print('Unable to find the inventory, open it and make sure the scanner window contains it')
+            return
+        self._apply_calibration(profile)
+        self._config[self._calibration_section] = profile.to_dict()
+        self._save_config()
 
-    return scale
+        x, y, width, height = profile.scanner_window_size
+        scanner_window_to_show = UIOverlay.create_toplevel_window(bg='white')
+        scanner_window_to_show.geometry(f'{width}x{height}+{x}+{y}')
+        scanner_window_to_show.after(200, scanner_window_to_show.destroy)
+        print(f'Calibrated image scale {profile.scale}, scanner window {profile.scanner_window_size}')
+
+    def _apply_calibration(self, profile: CalibrationProfile) -> None:
+        self._items_map.scale = profile.scale
+        # The window resets the grid, so it goes first
+        self._image_scanner.scanner_window_size = profile.scanner_window_size
+        self._image_scanner.grid = profile.grid
+        self._watcher.reset()
+
+    def _clear_calibration(self) -> None:
+        self._config.remove_section(self._calibration_section)
+
+    def shutdown(self) -> None:
+        """
+        Stop the running calibration and write the queued scans before the program exits
+        """
+        if self._calibration_progress is not None:
+            self._calibration_progress.cancel()
+        self._calibration_executor.shutdown(wait=False, cancel_futures=True)
+        if self.ledger is not None:
+            # The writer is a daemon thread, so the queued scans would be lost without waiting for it
+            self.ledger.close()
 
+    def should_display_inventory_items(self) -> bool:
+        return self._display_inventory_items
+
+    def combos(self):
+        return self._combos
 
 def tk_main():
+    startup_time = time.perf_counter()
+    if sys.platform == 'win32':
+        # Make Tk report the physical screen size in pixels, the same as ImageGrab uses
+        try:
+            ctypes.windll.shcore.SetProcessDpiAwareness(1)
+        except (AttributeError, OSError):
+            pass
+
     # Create root as early as possible to initialize some modules (e.g. ImageTk)
     root = tk.Tk()
 
-    # There are probably better ways to get screen resoultions but I'm lazy
-    screen = ImageGrab.grab()
-    SCREEN_WIDTH, SCREEN_HEIGHT = screen.size
+    # Ask the window system for the resolution instead of capturing the whole screen
+    SCREEN_WIDTH, SCREEN_HEIGHT = root.winfo_screenwidth(), root.winfo_screenheight()
 
-    items_map = ArchnemesisItemsMap(calculate_default_scale(SCREEN_WIDTH, SCREEN_HEIGHT))
+    # The scan images are only needed for the first scan, so build them while the overlay is starting
+    items_map = ArchnemesisItemsMap(calculate_default_scale(SCREEN_WIDTH, SCREEN_HEIGHT), load_in_background=True)
 
     image_scanner = ImageScanner(SCREEN_WIDTH, SCREEN_HEIGHT, items_map)
 
     overlay = UIOverlay(root, items_map, image_scanner)
+    root.after_idle(lambda: print(f'Startup: overlay shown in {(time.perf_counter() - startup_time) * 1000:.0f} ms'))
+    items_map.add_images_ready_callback(lambda: print(f'Startup: scan images ready in {(time.perf_counter() - startup_time) * 1000:.0f} ms'))
     overlay.run()
 
-def main():
-    PATH = os.path.join(os.getenv('UserProfile'), r'Documents\My Games\Path of Exile\Screenshots')
-    print(ImageGrab.grab().size)
 
-    root = tk.Tk()
-    latest_img = os.path.join(PATH, max(os.listdir(PATH), key=lambda fn: int(fn[11:-4])))
-    with Image.open(latest_img) as screen:
-        SCREEN_WIDTH, SCREEN_HEIGHT = screen.size
-        items_map = ArchnemesisItemsMap(calculate_default_scale(SCREEN_WIDTH, SCREEN_HEIGHT))
-        image_scanner = ImageScanner(screen.crop(AREA), items_map)
-        result = image_scanner.scan()
-        print(result)
-        items = []
-        for name in result.keys():
-            items = items + [[loc[0], loc[1], name] for loc in result[name]]
-        for i in sorted(items):
-            print(i)
-        print('Count:', sum(map(lambda x: len(x), result.values())))
-        result = dict([x, len(result[x])] for x in result.keys() if len(result[x]) > 0)
-        combos = [
-            ['Innocence-Touched', 'Brine King-Touched', 'Kitava-Touched', 'Treant Horde'],
-            ['Innocence-Touched', 'Brine King-Touched', 'Kitava-Touched', 'Treant Horde'],
-            ['Mirror Image', 'Assassin', 'Rejuvenating', 'Treant Horde'],
-            ['Mirror Image', 'Assassin', 'Rejuvenating', 'Treant Horde'],
-            ['Arakaali-Touched', 'Brine King-Touched', 'Effigy', 'Treant Horde']
-        ]
-        recipe = 1
-        while recipe > 0:
-            recipe = 0
-            for combo in combos:
-                recipe += items_map.eval(combo, result)
-        for item, count in sorted([(x, result[x]) for x in result.keys()]):
-            print(item, count)
-
-tk_main()
\ No newline at end of file
+if __name__ == '__main__':
+    tk_main()
@@ -0,0 +1,289 @@
+"""
+Local scan service which keeps the scan templates warm for several clients.
+
+Overlays, scripts and the batch scanner could send their full screen screenshots to one long-running process instead
+of each building the templates for themselves. The service only listens on localhost.
+
+    python poe_arch_service.py --port 8765 --workers 2 --warm 2560x1440
+
+POST /scan scans one screenshot. The body is either the encoded image (PNG, JPEG or BMP) or, with the
+application/json content type, {"shm": "<name>", "shape": [height, width, 3]} pointing to a BGR screenshot in shared
+memory, which saves the encoding. The combos could be passed as the JSON list in the `combos` query
+parameter. The response is the same JSON as one line of poe_arch_batch.py plus the request latency.
+
+GET /stats returns the number of the handled requests, the queue length and the latency percentiles.
+"""
+import sys
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+from concurrent.futures import Future, TimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import shared_memory, resource_tracker
+from urllib.parse import urlparse, parse_qs
+from typing import Tuple, List, Dict, Optional, Any
+
+import cv2
+import numpy as np
+
+from poe_arch_engine import ArchnemesisItemsMap, ImageScanner, RecipePlanner, ScanLedger, add_scanner_arguments, check_combos, create_scanner, options_scale, parse_resolution, scan_screenshot
+
+
+class ScanRequest:
+    """
+    Screenshot waiting in the service queue
+    """
+    __slots__ = ('screen', 'combos', 'future', 'received')
+
+    def __init__(self, screen: np.ndarray, combos: List[List[str]]):
+        self.screen = screen
+        self.combos = combos
+        self.future = Future()
+        self.received = time.perf_counter()
+
+
+class ScanService:
+    """
+    Scans the queued screenshots on a fixed number of worker threads. Every worker takes all the waiting requests
+    (up to the batch size) at once and scans them grouped by the resolution, so its scanners stay warm. The
+    templates of every scale are built once and shared by all workers.
+    """
+    # Number of the latest requests the latency statistics are calculated from
+    STATS_WINDOW = 1000
+
+    def __init__(self, options: argparse.Namespace):
+        self._options = options
+        self._queue = queue.Queue(maxsize=options.queue_size)
+        self._items_maps: Dict[float, ArchnemesisItemsMap] = dict()
+        self._items_maps_lock = threading.Lock()
+        self._planner = None
+        self._latencies = collections.deque(maxlen=ScanService.STATS_WINDOW)
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._ledger = ScanLedger(options.ledger) if options.ledger is not None else None
+        # Every worker has its own scanners because they keep the state of the previous scans
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(options.workers)]
+
+    def start(self) -> None:
+        for resolution in self._options.warm:
+            self._items_map(*resolution)
+        for worker in self._workers:
+            worker.start()
+
+    def close(self) -> None:
+        """
+        Write the scans still queued for the ledger
+        """
+        if self._ledger is not None:
+            self._ledger.close()
+
+    def submit(self, screen: np.ndarray, combos: List[List[str]]) -> Future:
+        """
+        Queue the BGR screenshot. Raises queue.Full if the service is overloaded.
+        """
+        request = ScanRequest(screen, combos)
+        self._queue.put_nowait(request)
+        return request.future
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            latencies = list(self._latencies)
+            requests, errors = self._requests, self._errors
+        return {
+            'requests': requests,
+            'errors': errors,
+            'queued': self._queue.qsize(),
+            'workers': len(self._workers),
+            'latency_ms': {
+                'p50': round(float(np.percentile(latencies, 50)), 3),
+                'p95': round(float(np.percentile(latencies, 95)), 3),
+            } if latencies else None,
+        }
+
+    def _items_map(self, screen_width: int, screen_height: int) -> ArchnemesisItemsMap:
+        scale = options_scale(self._options, screen_width, screen_height)
+        with self._items_maps_lock:
+            items_map = self._items_maps.get(scale)
+            if items_map is None:
+                items_map = ArchnemesisItemsMap(scale)
+                self._items_maps[scale] = items_map
+                if self._planner is None:
+                    # The recipes don't depend on the scale, so one planner serves all scanners
+                    self._planner = RecipePlanner(items_map)
+        return items_map
+
+    def _create_scanner(self, screen_width: int, screen_height: int) -> ImageScanner:
+        items_map = self._items_map(screen_width, screen_height)
+        # The scale bank changes the scale of its items map, so the scanner can't share it
+        shared_items_map = items_map if self._options.scale_bank == 0 else None
+        # The workers scan in parallel already, so they split the cores
+        return create_scanner(screen_width, screen_height, self._options, max((os.cpu_count() or 1) // len(self._workers), 1), shared_items_map)
+
+    def _work(self) -> None:
+        scanners: Dict[Tuple[int, int], ImageScanner] = dict()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._options.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch.sort(key=lambda request: request.screen.shape[:2])
+            for request in batch:
+                # The requests which have timed out are cancelled by their handlers
+                if request.future.set_running_or_notify_cancel():
+                    self._scan(request, scanners, len(batch))
+
+    def _scan(self, request: ScanRequest, scanners: Dict[Tuple[int, int], ImageScanner], batch_size: int) -> None:
+        start = time.perf_counter()
+        screen_height, screen_width = request.screen.shape[:2]
+        try:
+            scanner = scanners.get((screen_width, screen_height))
+            if scanner is None:
+                scanner = self._create_scanner(screen_width, screen_height)
+                scanners[(screen_width, screen_height)] = scanner
+            result = scan_screenshot(scanner, self._planner, request.screen, request.combos)
+        except Exception as e:
+            # The worker must survive anything, otherwise all the following requests would wait for nothing
+            print(f'Unable to scan the request: {e!r}', file=sys.stderr)
+            with self._stats_lock:
+                self._requests += 1
+                self._errors += 1
+            request.future.set_result({'error': str(e)})
+            return
+        end = time.perf_counter()
+        result['batch_size'] = batch_size
+        result['queue_ms'] = round((start - request.received) * 1000, 1)
+        result['scan_ms'] = round((end - start) * 1000, 1)
+        result['elapsed_ms'] = round((end - request.received) * 1000, 1)
+        if self._ledger is not None and len(result['items']) > 0:
+            self._ledger.record(result['items'], [(recipe['item'], recipe['locations'], recipe['in_inventory']) for recipe in result['recipes']])
+        with self._stats_lock:
+            self._requests += 1
+            self._latencies.append(result['elapsed_ms'])
+        request.future.set_result(result)
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    # Long enough for the first scan of a new resolution, which builds its templates
+    SCAN_TIMEOUT = 120
+
+    def do_GET(self) -> None:
+        if urlparse(self.path).path != '/stats':
+            self._send_json(404, {'error': 'not found'})
+            return
+        self._send_json(200, self.server.service.stats())
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path != '/scan':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            query = parse_qs(url.query)
+            combos = check_combos(json.loads(query['combos'][0])) if 'combos' in query else self.server.combos
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        except (ValueError, OSError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                screen = ScanRequestHandler._read_shared_memory(json.loads(body))
+            else:
+                screen = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if screen is None:
+                    raise ValueError('unable to decode the image')
+            future = self.server.service.submit(screen, combos)
+        except (ValueError, KeyError, TypeError, OSError, cv2.error) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except queue.Full:
+            self._send_json(503, {'error': 'too many queued requests'})
+            return
+        try:
+            result = future.result(timeout=ScanRequestHandler.SCAN_TIMEOUT)
+        except TimeoutError:
+            # Drop the request if it's still queued, the running scan just finishes for nobody
+            future.cancel()
+            self._send_json(504, {'error': 'the scan has timed out'})
+            return
+        # The request problems are rejected before it's queued, so a failed scan is the service's fault
+        self._send_json(200 if 'error' not in result else 500, result)
+
+    @staticmethod
+    def _read_shared_memory(description: Dict[str, Any]) -> np.ndarray:
+        """
+        Copy the screenshot out of the client's shared memory. The copy is cheap next to a scan, and the request may
+        outlive the handler (when it times out), so it must not keep the memory mapped.
+        """
+        shape = tuple(int(value) for value in description['shape'])
+        if len(shape) != 3 or shape[2] != 3:
+            raise ValueError('expected the [height, width, 3] BGR shape')
+        try:
+            memory = shared_memory.SharedMemory(name=description['shm'], track=False)
+        except TypeError:
+            # Python before 3.13 registers every attached memory with the resource tracker, which would remove the
+            # client's memory when the service exits
+            memory = shared_memory.SharedMemory(name=description['shm'])
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        try:
+            if memory.size < int(np.prod(shape)):
+                raise ValueError('the shared memory is smaller than the shape')
+            view = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+            screen = view.copy()
+            # The buffer can't be closed while a view of it exists
+            del view
+            return screen
+        finally:
+            memory.close()
+
+    def _send_json(self, status: int, value: Dict[str, Any]) -> None:
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        print(f'{self.address_string()} {format % args}', file=sys.stderr)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Serve the scanner with warm templates to the local clients over HTTP')
+    parser.add_argument('--port', type=int, default=8765, help='port on localhost to listen on (default: 8765)')
+    parser.add_argument('--workers', type=int, default=1, help='number of the screenshots scanned at the same time (default: 1)')
+    parser.add_argument('--batch-size', type=int, default=8, help='most requests a worker takes from the queue at once (default: 8)')
+    parser.add_argument('--queue-size', type=int, default=32, help='most requests waiting in the queue, the others get 503 (default: 32)')
+    parser.add_argument('--warm', type=parse_resolution, nargs='*', default=[], help='screen resolutions as WIDTHxHEIGHT to build the templates for on start')
+    add_scanner_arguments(parser)
+    parser.add_argument('--ledger', default=None, help='record every scan with items into this SQLite scan ledger')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    options = parse_args(argv)
+    service = ScanService(options)
+    service.start()
+    server = ThreadingHTTPServer(('127.0.0.1', options.port), ScanRequestHandler)
+    server.service = service
+    server.combos = options.combos
+    print(f'Scan service listening on http://127.0.0.1:{options.port}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())